@@ -0,0 +1,287 @@
+""" Standalone benchmarks of larvaci hot paths, results are written as JSON
+
+    python benchmarks/bench.py --output results.json
+    python benchmarks/bench.py --only command read_stdout
+
+Compare result files of two releases to catch regressions. Numbers are comparable only between runs
+on the same host.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import logging
+import tempfile
+import platform
+import threading
+import subprocess
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiohttp import web
+from larvaci.command import Command
+from larvaci.github import GitHubClient, make_session
+from larvaci.store import JournalStore, SqliteStore
+from larvaci.utils import PullRequestProcessorFlowBase
+
+
+# producers write `size` bytes to STDOUT
+_LINES_PRODUCER = """
+import sys
+line = b"x" * 79 + b"\\n"
+block = line * 1024
+left = int(sys.argv[1])
+while left > 0:
+    sys.stdout.buffer.write(block[:left])
+    left -= len(block)
+"""
+
+_BINARY_PRODUCER = """
+import os, sys
+block = os.urandom(1 << 20)
+left = int(sys.argv[1])
+while left > 0:
+    sys.stdout.buffer.write(block[:left])
+    left -= len(block)
+"""
+
+_PRODUCERS = {
+    "lines": _LINES_PRODUCER,
+    "binary": _BINARY_PRODUCER
+}
+
+
+def _null_logger(name):
+    """ Logger formatting records and writing them to /dev/null, like a real file logger """
+    logger = logging.getLogger(f"bench.{name}")
+    handler = logging.StreamHandler(open(os.devnull, "w"))
+    handler.setFormatter(logging.Formatter(fmt="%(asctime)s [%(levelname)s] %(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    return logger
+
+
+def _percentiles(samples):
+    samples = sorted(samples)
+    pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))]
+    return {
+        "mean": statistics.mean(samples),
+        "p50": pick(0.5),
+        "p90": pick(0.9),
+        "p99": pick(0.99),
+        "max": samples[-1]
+    }
+
+
+# -------------------------------------------------------------------------------------------------
+async def bench_command(size_mb, tmpdir):
+    """ Output throughput of processes through every kind of sink """
+    size = size_mb << 20
+    results = {}
+    for producer_name, producer in _PRODUCERS.items():
+        args = [sys.executable, "-c", producer, str(size)]
+        sinks = {
+            "logger": None,
+            "file": os.path.join(tmpdir, "output"),
+            "devnull": subprocess.DEVNULL
+        }
+        for sink_name, sink in sinks.items():
+            command = Command(logger=_null_logger(f"{producer_name}.{sink_name}"))
+            t0 = time.monotonic()
+            await command.exec(args, stdout=sink)
+            dur = time.monotonic() - t0
+            results[f"{producer_name}/{sink_name}"] = {"seconds": dur, "mb_per_second": size_mb / dur}
+    return results
+
+
+async def bench_read_stdout(lines):
+    """ Iteration rate of `read_stdout_until` over short lines """
+    producer = f"import sys\nsys.stdout.write('line of output\\n' * {lines})"
+    command = Command(logger=_null_logger("read_stdout"))
+    results = {}
+    for raw in (False, True):
+        count = 0
+        t0 = time.monotonic()
+        async for _ in command.read_stdout_until([sys.executable, "-c", producer], raw=raw):
+            count += 1
+        dur = time.monotonic() - t0
+        results["raw" if raw else "decoded"] = {"lines": count, "seconds": dur, "lines_per_second": count / dur}
+    return results
+
+
+class _BenchFlow(PullRequestProcessorFlowBase):
+    REPO_OWNER = "bench"
+    REPO_NAME = "bench"
+
+
+def _pr(i):
+    return {"id": f"PR_{i}", "baseRefOid": f"{i:040x}", "headRefOid": f"{i + 1:040x}"}
+
+
+async def bench_pr_context(history_sizes, lookups, tmpdir):
+    """ Cost of `get_pr_context` as the history of processed PRs grows """
+    results = {}
+    for store_cls in (JournalStore, SqliteStore):
+        for history in history_sizes:
+            workdir = tempfile.mkdtemp(dir=tmpdir)
+            flow_cls = type("Flow", (_BenchFlow, ), {"STORE_CLASS": store_cls, "STORE_CAPACITY": history})
+            flow = flow_cls(workdir=workdir, logger=_null_logger("flow"), github_token="none")
+
+            t0 = time.monotonic()
+            for i in range(history):
+                flow.save_processed_pull_request(_pr(i), flow.RES_SUCCESS, 1)
+            save_dur = time.monotonic() - t0
+            flow.store.close()
+
+            t0 = time.monotonic()
+            flow = flow_cls(workdir=workdir, logger=_null_logger("flow"), github_token="none")
+            load_dur = time.monotonic() - t0
+
+            t0 = time.monotonic()
+            for i in range(lookups):
+                flow.get_pr_context(_pr(i % (2 * history)))  # half of lookups miss
+            lookup_dur = time.monotonic() - t0
+            flow.store.close()
+
+            results[f"{store_cls.__name__}/{history}"] = {
+                "save_us": save_dur / history * 1e6,
+                "load_seconds": load_dur,
+                "lookup_us": lookup_dur / lookups * 1e6
+            }
+    return results
+
+
+def _start_fake_endpoint():
+    """ GraphQL endpoint answering every query with a small fixed response, in its own thread and loop """
+    response = json.dumps({"data": {"repository": {"id": "R", "url": "u", "sshUrl": "git@localhost:r.git"}}})
+
+    async def handle(request):
+        await request.read()
+        return web.Response(text=response, content_type="application/json")
+
+    started = threading.Event()
+    state = {}
+
+    def serve():
+        eloop = asyncio.new_event_loop()
+        app = web.Application()
+        app.router.add_post("/graphql", handle)
+        runner = web.AppRunner(app, access_log=None)
+        eloop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        eloop.run_until_complete(site.start())
+        state["port"] = runner.addresses[0][1]
+        state["loop"] = eloop
+        started.set()
+        eloop.run_forever()
+        eloop.run_until_complete(runner.cleanup())
+        eloop.close()
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    started.wait()
+
+    def stop():
+        state["loop"].call_soon_threadsafe(state["loop"].stop)
+        thread.join()
+    return f"http://127.0.0.1:{state['port']}/graphql", stop
+
+
+async def bench_github_request(requests, concurrency):
+    """ Latency of `GitHubClient.request` against a local endpoint (the overhead of the client itself) """
+    url, stop = _start_fake_endpoint()
+    query = {"query": "query { repository(owner: \"o\", name: \"r\") { id url sshUrl } }"}
+    results = {}
+    try:
+        session = make_session(limit=concurrency)
+        client = GitHubClient(token="none", logger=_null_logger("github"), session=session, url=url)
+        await client.request(query)  # warm up the connection
+
+        latencies = []
+        for _ in range(requests):
+            t0 = time.monotonic()
+            await client.request(query)
+            latencies.append(time.monotonic() - t0)
+        results["sequential_ms"] = _percentiles([l * 1e3 for l in latencies])
+
+        async def timed():
+            t0 = time.monotonic()
+            await client.request(query)
+            return time.monotonic() - t0
+
+        t0 = time.monotonic()
+        latencies = await asyncio.gather(*(timed() for _ in range(requests)))
+        dur = time.monotonic() - t0
+        results["concurrent_ms"] = _percentiles([l * 1e3 for l in latencies])
+        results["concurrent_requests_per_second"] = requests / dur
+
+        await client.close()
+        await session.close()
+    finally:
+        stop()
+    return results
+
+
+# -------------------------------------------------------------------------------------------------
+async def run(args):
+    tmpdir = tempfile.mkdtemp(prefix="larvaci-bench-")
+    benchmarks = {
+        "command": lambda: bench_command(args.size, tmpdir),
+        "read_stdout": lambda: bench_read_stdout(args.lines),
+        "pr_context": lambda: bench_pr_context(args.history, args.lookups, tmpdir),
+        "github_request": lambda: bench_github_request(args.requests, args.concurrency)
+    }
+    report = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "revision": _revision(),
+        "results": {}
+    }
+    try:
+        for name, bench in benchmarks.items():
+            if args.only and name not in args.only:
+                continue
+            logging.info(f"Run benchmark {name} ...")
+            report["results"][name] = await bench()
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return report
+
+
+def _revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output",      help="File to write JSON results into (STDOUT by default)", default=None)
+    parser.add_argument("--only",        help="Run only these benchmarks", nargs="+", default=None,
+                        choices=["command", "read_stdout", "pr_context", "github_request"])
+    parser.add_argument("--size",        help="MiB written by output producers", default=64, type=int)
+    parser.add_argument("--lines",       help="Lines read via read_stdout_until", default=200000, type=int)
+    parser.add_argument("--history",     help="Sizes of PR history", nargs="+", default=[100, 1000, 10000], type=int)
+    parser.add_argument("--lookups",     help="Number of PR context lookups", default=100000, type=int)
+    parser.add_argument("--requests",    help="Number of GitHub API requests", default=500, type=int)
+    parser.add_argument("--concurrency", help="Connections used by concurrent requests", default=10, type=int)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    report = asyncio.run(run(args))
+    if args.output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
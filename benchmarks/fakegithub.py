@@ -0,0 +1,389 @@
+""" Local stand-in for api.github.com/graphql backed by local bare git repositories
+
+Serves queries and mutations larvaci makes (repository, pullRequests, addComment, updateIssueComment and
+their aliased batches) for a scripted scenario: `repos` repositories with `prs` open PRs each, pushes to
+PR branches arriving at a given rate, injected latency and error rate. Requests are charged against a
+GitHub-like rate limit budget, reported via `rateLimit`.
+
+A comment mentioning a PR revision (its headRefOid) is taken as feedback on it: the time from the push
+to the first such comment is the time-to-feedback.
+
+    python benchmarks/fakegithub.py --repos 2 --prs 10 --push-rate 1 --port 8300
+"""
+import os
+import re
+import json
+import math
+import time
+import random
+import asyncio
+import logging
+import itertools
+import statistics
+from collections import Counter
+from aiohttp import web
+
+
+_GIT_ENV = dict(
+    os.environ,
+    GIT_AUTHOR_NAME="fakegithub", GIT_AUTHOR_EMAIL="fakegithub@localhost",
+    GIT_COMMITTER_NAME="fakegithub", GIT_COMMITTER_EMAIL="fakegithub@localhost"
+)
+_OID = re.compile(r"\b[0-9a-f]{40}\b")
+
+
+async def _git(repo_dir, *args, input=None):
+    proc = await asyncio.create_subprocess_exec(
+        "git", *args, cwd=repo_dir, env=_GIT_ENV,
+        stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+    stdout, stderr = await proc.communicate(input.encode("utf-8") if input is not None else None)
+    if proc.returncode != 0:
+        raise RuntimeError(f"git {args} failed: {stderr.decode()}")
+    return stdout.decode("utf-8").strip()
+
+
+def _now_iso():
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+
+
+def _percentiles(samples):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))]
+    return {
+        "count": len(samples),
+        "mean": statistics.mean(samples),
+        "p50": pick(0.5),
+        "p90": pick(0.9),
+        "p99": pick(0.99),
+        "max": samples[-1]
+    }
+
+
+class FakeRepo:
+    def __init__(self, owner, name, path):
+        self.owner = owner
+        self.name = name
+        self.path = path
+        self.base_oid = None
+        self.base_entries = None
+        self.prs = []
+
+
+class FakeGitHub:
+    def __init__(self, basedir, repos=1, prs=10, latency=0.0, error_rate=0.0, owner="fake", seed=None,
+                 logger=None, rate_limit=5000, rate_limit_window=3600):
+        """
+        `latency` - mean delay (seconds) of every response, actual delays are uniform in [0.5, 1.5] of it
+        `error_rate` - share of requests failed with HTTP 502 or a GraphQL error
+        `rate_limit` - points per `rate_limit_window` seconds, a request costs a point (an aliased
+        pullRequests query costs a point per 100 repositories), requests beyond it fail with RATE_LIMITED
+        """
+        self.basedir = basedir
+        self.repo_count = repos
+        self.pr_count = prs
+        self.latency = latency
+        self.error_rate = error_rate
+        self.owner = owner
+        self.random = random.Random(seed)
+        self.logger = logger or logging.getLogger()
+        self.rate_limit = rate_limit
+        self.rate_limit_window = rate_limit_window
+        self.rate_remaining = rate_limit
+        self.rate_reset = time.time() + rate_limit_window
+
+        self.repos = {}
+        self.prs = {}  # id -> (repo, pr)
+        self.pushed_at = {}  # headRefOid -> (time of push, initial revision or not)
+        self.feedback = {}  # headRefOid -> time-to-feedback
+        self.comments = {}  # comment id -> PR id
+        self.calls = Counter()
+        self.errors = Counter()
+        self.pushes = 0
+        self._ids = itertools.count()
+        self._runner = None
+
+    # ---------------------------------------------------------------------------------------------
+    async def setup(self):
+        """ Create bare repositories with a base branch and a branch per PR """
+        os.makedirs(self.basedir, exist_ok=True)
+        for r in range(self.repo_count):
+            name = f"repo{r}"
+            repo = FakeRepo(self.owner, name, os.path.join(self.basedir, f"{name}.git"))
+            await _git(self.basedir, "init", "--quiet", "--bare", repo.path)
+
+            blob = await _git(repo.path, "hash-object", "-w", "--stdin", input=f"{name}\n")
+            repo.base_entries = f"100644 blob {blob}\tREADME\n"
+            tree = await _git(repo.path, "mktree", input=repo.base_entries)
+            repo.base_oid = await _git(repo.path, "commit-tree", tree, "-m", "base")
+            await _git(repo.path, "update-ref", "refs/heads/main", repo.base_oid)
+
+            for number in range(1, self.pr_count + 1):
+                pr = {
+                    "id": f"PR_{name}_{number}",
+                    "number": number,
+                    "title": f"PR {number} of {name}",
+                    "state": "OPEN",
+                    "createdAt": _now_iso(),
+                    "updatedAt": _now_iso(),
+                    "baseRefName": "main",
+                    "baseRefOid": repo.base_oid,
+                    "headRefName": f"pr{number}",
+                    "headRefOid": repo.base_oid,
+                    "revisions": 0
+                }
+                repo.prs.append(pr)
+                self.prs[pr["id"]] = (repo, pr)
+                await self._commit(repo, pr, initial=True)
+            self.repos[(self.owner, name)] = repo
+
+    async def _commit(self, repo, pr, initial=False):
+        pr["revisions"] += 1
+        blob = await _git(repo.path, "hash-object", "-w", "--stdin", input=f"revision {pr['revisions']}\n")
+        tree = await _git(repo.path, "mktree", input=repo.base_entries + f"100644 blob {blob}\tpr{pr['number']}.txt\n")
+        oid = await _git(repo.path, "commit-tree", tree, "-p", pr["headRefOid"], "-m", f"revision {pr['revisions']}")
+        await _git(repo.path, "update-ref", f"refs/heads/pr{pr['number']}", oid)
+        await _git(repo.path, "update-ref", f"refs/pull/{pr['number']}/head", oid)
+        pr["headRefOid"] = oid
+        pr["updatedAt"] = _now_iso()
+        self.pushed_at[oid] = (time.monotonic(), initial)
+
+    def reset_clock(self):
+        """ Count time-to-feedback of initial revisions from now on """
+        now = time.monotonic()
+        for oid, (_, initial) in self.pushed_at.items():
+            if initial:
+                self.pushed_at[oid] = (now, True)
+
+    async def push(self):
+        """ Push a new revision to a random PR """
+        repo, pr = self.prs[self.random.choice(list(self.prs))]
+        await self._commit(repo, pr)
+        self.pushes += 1
+
+    async def run_pushes(self, rate, duration):
+        """ Push to random PRs `rate` times per second (Poisson arrivals) during `duration` seconds """
+        deadline = time.monotonic() + duration
+        while rate > 0:
+            delay = self.random.expovariate(rate)
+            if time.monotonic() + delay > deadline:
+                break
+            await asyncio.sleep(delay)
+            await self.push()
+
+    # ---------------------------------------------------------------------------------------------
+    def _feedback(self, pr_id, content):
+        repo, pr = self.prs.get(pr_id, (None, None))
+        if pr is None:
+            return
+        now = time.monotonic()
+        for oid in _OID.findall(content):
+            if oid in self.pushed_at and oid not in self.feedback:
+                self.feedback[oid] = now - self.pushed_at[oid][0]
+
+    def _add_comment(self, subject_id, content):
+        comment_id = f"COMMENT_{next(self._ids)}"
+        self.comments[comment_id] = subject_id
+        self._feedback(subject_id, content)
+        return {"commentEdge": {"cursor": comment_id, "node": {"id": comment_id}}}
+
+    def _update_comment(self, comment_id, content):
+        self._feedback(self.comments.get(comment_id), content)
+        return {"issueComment": {"id": comment_id}}
+
+    def _pull_requests(self, query, variables):
+        repo = self.repos.get((variables["repo_owner"], variables["repo_name"]))
+        if repo is None:
+            return {"repository": None}
+        light = "createdAt" not in query
+        first = int(re.search(r"first:\s*(\d+)", query).group(1))
+        start = int(variables.get("after") or 0)
+        nodes = []
+        for pr in repo.prs[start:start + first]:
+            node = {k: v for k, v in pr.items() if k != "revisions"}
+            if light:
+                node = {k: node[k] for k in ("id", "baseRefOid", "headRefOid")}
+            nodes.append(node)
+        return {"repository": {"pullRequests": {
+            "pageInfo": {"hasNextPage": start + first < len(repo.prs), "endCursor": str(start + first)},
+            "nodes": nodes
+        }}}
+
+    def _batch_pull_requests(self, query, variables):
+        data = {}
+        for i in itertools.count():
+            if f"repo_owner{i}" not in variables:
+                return data
+            page = self._pull_requests(query, {
+                "repo_owner": variables[f"repo_owner{i}"],
+                "repo_name": variables[f"repo_name{i}"]
+            })
+            data[f"r{i}"] = page["repository"]
+
+    def _cost(self, query, variables):
+        if "r0:" in query:
+            return max(1, math.ceil(sum(1 for name in variables if name.startswith("repo_owner")) / 100))
+        return 1
+
+    def _charge(self, cost):
+        """ Take `cost` points from the rate limit budget, False if there are not enough of them """
+        now = time.time()
+        if now >= self.rate_reset:
+            self.rate_remaining = self.rate_limit
+            self.rate_reset = now + self.rate_limit_window
+        if cost > self.rate_remaining:
+            return False
+        self.rate_remaining -= cost
+        return True
+
+    def _rate_limit(self, cost):
+        return {
+            "limit": self.rate_limit,
+            "cost": cost,
+            "remaining": self.rate_remaining,
+            "resetAt": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(self.rate_reset))
+        }
+
+    def _repository(self, variables):
+        repo = self.repos.get((variables["repo_owner"], variables["repo_name"]))
+        if repo is None:
+            return {"repository": None}
+        return {"repository": {"id": repo.name, "url": repo.path, "sshUrl": "file://" + repo.path}}
+
+    def _batch(self, variables):
+        data = {}
+        for i in itertools.count():
+            if f"content{i}" not in variables:
+                return data
+            if f"comment_id{i}" in variables:
+                data[f"m{i}"] = self._update_comment(variables[f"comment_id{i}"], variables[f"content{i}"])
+            else:
+                data[f"m{i}"] = self._add_comment(variables[f"subject_id{i}"], variables[f"content{i}"])
+
+    def _answer(self, query, variables):
+        if "m0:" in query:
+            self.calls["batch_comments"] += 1
+            return self._batch(variables)
+        if "r0:" in query:
+            self.calls["batch_pull_requests"] += 1
+            return self._batch_pull_requests(query, variables)
+        if "pullRequests" in query:
+            self.calls["pull_requests"] += 1
+            return self._pull_requests(query, variables)
+        if "sshUrl" in query:
+            self.calls["repository"] += 1
+            return self._repository(variables)
+        if "addComment" in query:
+            self.calls["add_comment"] += 1
+            return {"addComment": self._add_comment(variables["subject_id"], variables["content"])}
+        if "updateIssueComment" in query:
+            self.calls["update_comment"] += 1
+            return {"updateIssueComment": self._update_comment(variables["comment_id"], variables["content"])}
+        self.calls["unknown"] += 1
+        return None
+
+    async def handle(self, request):
+        body = await request.json()
+        if self.latency:
+            await asyncio.sleep(self.latency * self.random.uniform(0.5, 1.5))
+
+        if self.random.random() < self.error_rate:
+            if self.random.random() < 0.5:
+                self.errors["http_502"] += 1
+                return web.Response(status=502, text="Bad Gateway")
+            self.errors["graphql"] += 1
+            return web.json_response({"data": None, "errors": [{"message": "Something went wrong"}]})
+
+        query, variables = body["query"], body.get("variables") or {}
+        cost = self._cost(query, variables)
+        if not self._charge(cost):
+            self.errors["rate_limited"] += 1
+            return web.json_response({"data": None, "errors": [
+                {"type": "RATE_LIMITED", "message": "API rate limit exceeded"}
+            ]}, headers={"X-RateLimit-Remaining": "0", "X-RateLimit-Reset": str(int(self.rate_reset))})
+
+        data = self._answer(query, variables)
+        if data is None:
+            return web.json_response({"data": None, "errors": [{"message": "Unknown query"}]})
+        if "rateLimit" in query:
+            data["rateLimit"] = self._rate_limit(cost)
+        return web.json_response({"data": data})
+
+    async def start(self, host="127.0.0.1", port=0):
+        """ Start serving, return the GraphQL endpoint URL """
+        app = web.Application(client_max_size=16 << 20)
+        app.router.add_post("/graphql", self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        host, port = self._runner.addresses[0][:2]
+        url = f"http://{host}:{port}/graphql"
+        self.logger.info(f"Fake GitHub API is serving {len(self.prs)} PRs on {url}")
+        return url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    # ---------------------------------------------------------------------------------------------
+    def report(self):
+        latest = {pr["headRefOid"] for _, pr in self.prs.values()}
+        cold = [t for oid, t in self.feedback.items() if self.pushed_at[oid][1]]
+        pushed = [t for oid, t in self.feedback.items() if not self.pushed_at[oid][1]]
+        calls = sum(self.calls.values())
+        return {
+            "repos": self.repo_count,
+            "prs": len(self.prs),
+            "pushes": self.pushes,
+            "revisions": len(self.pushed_at),
+            "revisions_with_feedback": len(self.feedback),
+            "revisions_superseded": sum(1 for oid in self.pushed_at if oid not in self.feedback and oid not in latest),
+            "revisions_pending": sum(1 for oid in latest if oid not in self.feedback),
+            "cold_start_feedback_seconds": _percentiles(cold),
+            "push_feedback_seconds": _percentiles(pushed),
+            "api_calls": dict(self.calls),
+            "api_calls_total": calls,
+            "api_calls_per_pr": calls / max(1, len(self.prs)),
+            "api_calls_per_revision": calls / max(1, len(self.pushed_at)),
+            "injected_errors": dict(self.errors),
+            "rate_limit_remaining": self.rate_remaining
+        }
+
+
+# -------------------------------------------------------------------------------------------------
+if __name__ == "__main__":
+    import argparse
+    import tempfile
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--basedir",    help="Directory for bare repositories", default=None, type=str)
+    parser.add_argument("--repos",      help="Number of repositories", default=1, type=int)
+    parser.add_argument("--prs",        help="Open PRs per repository", default=10, type=int)
+    parser.add_argument("--push-rate",  help="Pushes per second to random PRs", default=0.0, type=float)
+    parser.add_argument("--latency",    help="Mean response delay in seconds", default=0.0, type=float)
+    parser.add_argument("--error-rate", help="Share of failed requests", default=0.0, type=float)
+    parser.add_argument("--rate-limit", help="Rate limit points per hour", default=5000, type=int)
+    parser.add_argument("--port",       help="Port to listen on", default=8300, type=int)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
+    async def serve():
+        fake = FakeGitHub(args.basedir or tempfile.mkdtemp(prefix="fakegithub-"), repos=args.repos, prs=args.prs,
+                          latency=args.latency, error_rate=args.error_rate, rate_limit=args.rate_limit)
+        await fake.setup()
+        await fake.start(port=args.port)
+        try:
+            await fake.run_pushes(args.push_rate, float("inf"))
+            await asyncio.Event().wait()
+        finally:
+            print(json.dumps(fake.report(), indent=2))
+            await fake.stop()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,112 @@
+""" Load simulation: main_loop with a flow per repository against the local fake GitHub API
+
+    python benchmarks/loadsim.py --repos 4 --prs 20 --push-rate 2 --duration 60 --output report.json
+
+Flows merge every PR revision into its base, "work" for `--work-time` seconds and post a comment with
+the revision hash. The report has time-to-feedback percentiles and GitHub API calls per PR.
+"""
+import os
+import sys
+import json
+import time
+import signal
+import asyncio
+import logging
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakegithub import FakeGitHub
+from larvaci.main import main_loop, register_flow
+from larvaci.utils import PullRequestProcessorFlowBase
+
+
+def make_flow(repo, args):
+    class Flow(PullRequestProcessorFlowBase):
+        REPO_OWNER = repo.owner
+        REPO_NAME = repo.name
+        MAX_PARALLEL = args.parallel
+        USE_WORKTREES = args.worktrees
+        delay = args.poll_delay
+        max_delay = args.poll_delay
+
+        async def process_pull_request(self, repodir, pr, rundir):
+            if not self.USE_WORKTREES:
+                await self.git.checkout(repodir, pr["baseRefOid"])
+                await self.git.clean(repodir)
+            await self.git.merge(repodir, pr["headRefOid"])
+            await asyncio.sleep(args.work_time)
+            await self.github.add_comment(subject_id=pr["id"], content=f"larvaci: {pr['headRefOid']} is fine")
+            return True
+
+    Flow.__name__ = Flow.__qualname__ = f"{repo.name.capitalize()}Flow"
+    return register_flow(Flow)
+
+
+async def simulate(args):
+    basedir = args.basedir or tempfile.mkdtemp(prefix="larvaci-loadsim-")
+    fake = FakeGitHub(os.path.join(basedir, "origin"), repos=args.repos, prs=args.prs, latency=args.latency,
+                      error_rate=args.error_rate, seed=args.seed, rate_limit=args.rate_limit)
+    await fake.setup()
+    url = await fake.start()
+    for repo in fake.repos.values():
+        make_flow(repo, args)
+
+    fake.reset_clock()
+    t0 = time.monotonic()
+    service = asyncio.create_task(main_loop(
+        workdir_base=os.path.join(basedir, "workdir"),
+        github_token="fake",
+        github_url=url,
+        max_cpus=args.max_cpus,
+        shared_poll=args.shared_poll
+    ))
+    await fake.run_pushes(args.push_rate, args.duration)
+
+    # let flows catch up with the last pushes
+    deadline = time.monotonic() + args.drain
+    while time.monotonic() < deadline and fake.report()["revisions_pending"]:
+        await asyncio.sleep(0.5)
+
+    os.kill(os.getpid(), signal.SIGTERM)  # main_loop stops on it like a real service
+    await service
+    await fake.stop()
+
+    report = fake.report()
+    report["seconds"] = time.monotonic() - t0
+    report["settings"] = {k: v for k, v in vars(args).items() if k not in ("output", "basedir")}
+    return report
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output",     help="File to write JSON report into (STDOUT by default)", default=None)
+    parser.add_argument("--basedir",    help="Directory for repositories and flow workdirs", default=None)
+    parser.add_argument("--repos",      help="Number of repositories, a flow per each", default=2, type=int)
+    parser.add_argument("--prs",        help="Open PRs per repository", default=10, type=int)
+    parser.add_argument("--push-rate",  help="Pushes per second to random PRs", default=1.0, type=float)
+    parser.add_argument("--duration",   help="Seconds of pushing", default=30.0, type=float)
+    parser.add_argument("--drain",      help="Max seconds to wait for feedback after pushes", default=60.0, type=float)
+    parser.add_argument("--latency",    help="Mean GitHub API response delay in seconds", default=0.05, type=float)
+    parser.add_argument("--error-rate", help="Share of failed GitHub API requests", default=0.0, type=float)
+    parser.add_argument("--rate-limit", help="GitHub API rate limit points per hour", default=5000, type=int)
+    parser.add_argument("--shared-poll", help="Poll all repositories at once every SECONDS", default=None,
+                        type=float)
+    parser.add_argument("--work-time",  help="Seconds every PR run takes", default=0.5, type=float)
+    parser.add_argument("--poll-delay", help="Seconds between polls of a flow", default=2.0, type=float)
+    parser.add_argument("--parallel",   help="PRs processed at once by a flow", default=2, type=int)
+    parser.add_argument("--worktrees",  help="Use worktrees of a shared mirror", action="store_true", default=False)
+    parser.add_argument("--max-cpus",   help="CPU slots shared by all flows", default=None, type=int)
+    parser.add_argument("--seed",       help="Seed of the scenario", default=None, type=int)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    report = asyncio.run(simulate(args))
+    if args.output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
@@ -1,26 +1,56 @@
+import re
+import signal
 import logging
 import asyncio
 import subprocess
 import time
+import json
 import sys
+import os
+from .metrics import Gauge, Histogram
+from .trace import span
 
 
 # -------------------------------------------------------------------------------------------------
-async def _output_to_logger(reader, logger, prefix=""):
+_CHUNK_SIZE = 1 << 16  # read output by big chunks instead of lines
+_MAX_LINE = 1 << 20  # longer lines are logged in pieces
+_DRAIN_TIMEOUT = 10  # seconds to wait for output tails after process exit
+_RUSAGE_WRAPPER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rusage.py")
+
+PROCESS_SECONDS = Histogram("larvaci_process_seconds", "Wall time of finished subprocesses",
+                            labels=("program", "status"))
+PROCESSES_RUNNING = Gauge("larvaci_processes_running", "Subprocesses started and not waited for yet")
+
+
+async def _output_to_logger(reader, logger, prefix="", extra=None):
+    tail = b""
     while True:
-        l = await reader.readline()
-        if not l:
+        chunk = await reader.read(_CHUNK_SIZE)
+        if not chunk:
+            if tail:
+                logger.info(prefix + tail.decode("utf-8", errors="ignore").strip(), extra=extra)
             return
-        s = l.decode("utf-8", errors="ignore").strip()
-        logger.info(prefix + s)
+
+        data = tail + chunk
+        end = data.rfind(b"\n")
+        if end < 0:
+            if len(data) < _MAX_LINE:
+                tail = data
+                continue
+            end = len(data)
+        tail = data[end + 1:]
+
+        # one read per chunk, but still one log record per line
+        for line in data[:end].decode("utf-8", errors="ignore").split("\n"):
+            logger.info(prefix + line.strip(), extra=extra)
 
 
 async def _output_to_fobj(reader, fobj):
     while True:
-        l = await reader.readline()
-        if not l:
+        chunk = await reader.read(_CHUNK_SIZE)
+        if not chunk:
             return
-        fobj.write(l)
+        fobj.write(chunk)
 
 
 async def _output_to_file(reader, fname):
@@ -29,17 +59,141 @@ async def _output_to_file(reader, fname):
 
 
 async def _output_to_devnull(reader):
-    while (await reader.read(1024)):
+    while (await reader.read(_CHUNK_SIZE)):
         pass
 
 
+class _WatchedReader:
+    """ Stream reader passing every chunk read through watchers of the stream """
+
+    def __init__(self, reader, process, name):
+        self._reader = reader
+        self._process = process
+        self._name = name
+
+    async def read(self, n=-1):
+        chunk = await self._reader.read(n)
+        self._process._watch(self._name, chunk)
+        return chunk
+
+
+def _fileno(out):
+    """ File descriptor of `out` if the child process can write to it directly, None otherwise """
+    if isinstance(out, logging.Logger) or not hasattr(out, "write"):
+        return None
+    try:
+        fd = out.fileno()
+    except (AttributeError, OSError, ValueError):
+        return None
+    out.flush()
+    return fd
+
+
+# -------------------------------------------------------------------------------------------------
+class ResourceUsage:
+    """ Resources consumed by a process and all its descendants
+
+    Everything except `wall_time` is None unless the process was run with `rusage=True`
+    """
+
+    def __init__(self, wall_time, user_time=None, system_time=None, max_rss=None, read_blocks=None,
+                 write_blocks=None):
+        self.wall_time = wall_time
+        self.user_time = user_time
+        self.system_time = system_time
+        self.max_rss = max_rss  # KiB, the biggest process of the tree
+        self.read_blocks = read_blocks  # 512-byte blocks
+        self.write_blocks = write_blocks
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+    def __str__(self):
+        s = f"wall={self.wall_time:.3f}s"
+        if self.user_time is not None:
+            s += (f" user={self.user_time:.3f}s sys={self.system_time:.3f}s max_rss={self.max_rss}KiB"
+                  f" read_blocks={self.read_blocks} write_blocks={self.write_blocks}")
+        return s
+
+
+class Watcher:
+    """ Pattern looked for in STDOUT/STDERR of a process while it runs
+
+    Output is matched by chunks with one regex scan each, not line by line. A match may span lines, but
+    not a chunk boundary unless the match is within the last (unterminated) line of the previous chunk.
+    """
+
+    def __init__(self, pattern, literal=False, streams=("STDOUT", "STDERR"), callback=None, abort=False,
+                 collect=True, max_matches=100, flags=0):
+        """
+        `pattern` - regular expression (str, bytes or compiled) or a literal string if `literal` is set
+        `callback` - callable(watcher, match) called on every match (`re.Match` object on bytes)
+        `abort` - kill the whole process tree on the first match, the process raises `ProcessAborted`
+        `collect` - keep up to `max_matches` matched strings in `matches`
+        """
+        if isinstance(pattern, str):
+            pattern = pattern.encode("utf-8")
+        if literal:
+            pattern = re.escape(pattern)
+        self.regex = pattern if hasattr(pattern, "finditer") else re.compile(pattern, flags)
+        self.streams = tuple(streams)
+        self.callback = callback
+        self.abort = abort
+        self.collect = collect
+        self.max_matches = max_matches
+        self.matches = []
+        self.count = 0
+
+    def _scan(self, data, start, process, stream):
+        for match in self.regex.finditer(data):
+            if match.end() <= start:
+                continue  # was reported with the previous chunk
+            self.count += 1
+            if self.collect and len(self.matches) < self.max_matches:
+                self.matches.append(match.group(0).decode("utf-8", errors="ignore"))
+            if self.callback is not None:
+                self.callback(self, match)
+            if self.abort:
+                process.abort(self, match, stream)
+                return
+
+
+class ProcessAborted(RuntimeError):
+    """ Process was killed because a watcher found its pattern in the output """
+
+    def __init__(self, watcher, text):
+        super().__init__(f"process aborted, output matched {watcher.regex.pattern!r}: {text!r}")
+        self.watcher = watcher
+        self.text = text
+
+
+class ProcessResult(int):
+    """ Return code of a finished process (compares as int) with its resource usage """
+
+    def __new__(cls, returncode, usage):
+        result = super().__new__(cls, returncode)
+        result.usage = usage
+        return result
+
+    @property
+    def returncode(self):
+        return int(self)
+
+
 # -------------------------------------------------------------------------------------------------
 class Process:
     STDOUT = "STDOUT"
     STDERR = "STDERR"
 
     async def __aenter__(self):
-        await self._run()
+        self._span = span(f"process {os.path.basename(self._args[0])}", cat="process", args=self._args,
+                          cwd=self._cwd)
+        self._span.__enter__()
+        try:
+            await self._run()
+        except BaseException as err:
+            self._span.__exit__(type(err), err, None)
+            raise
         return self
 
     async def __aexit__(self, exc_type, exc_value, traceback):
@@ -48,32 +202,99 @@ class Process:
                 await self.terminate()
             except ProcessLookupError:
                 pass
+        if self.usage is None:  # not waited for, e.g. it had exited already
+            self._finish(self.returncode)
+        for task in self._pumps:
+            task.cancel()
+        if self._rusage_fd is not None:
+            os.close(self._rusage_fd)
+            self._rusage_fd = None
+        self._span.set(returncode=self.returncode)
+        self._span.__exit__(exc_type, exc_value, traceback)
 
     def _redirect_output(self, reader, out):
         name = "STDERR" if (reader is self._proc.stderr) else "STDOUT"
+        if self._watchers[name]:
+            reader = _WatchedReader(reader, self, name)
 
         if isinstance(out, logging.Logger):
             dst = "logger (info level)"
-            asyncio.create_task(_output_to_logger(reader, out, prefix=f"[PID={self.pid}, {name}] "))
+            pump = _output_to_logger(reader, out, prefix=f"[PID={self.pid}, {name}] ", extra={"pid": self.pid})
         elif out == subprocess.DEVNULL:
             dst = "DEVNULL"
-            asyncio.create_task(_output_to_devnull(reader))
+            pump = _output_to_devnull(reader)
         elif hasattr(out, "write"):
             dst = f"FileObject ({out})"
-            asyncio.create_task(_output_to_fobj(reader, out))
+            pump = _output_to_fobj(reader, out)
         elif isinstance(out, str):
             dst = f"file ({out})"
-            asyncio.create_task(_output_to_file(reader, out))
+            pump = _output_to_file(reader, out)
         else:
             raise RuntimeError(f"invalid 'out' argument: {out}")
 
+        self._pumps.append(asyncio.create_task(pump))
+        self._redirected.add(name)
         self.logger.info(f"Redirect {name} of process PID={self.pid} to {dst}")
 
-    def __init__(self, args, cwd, logger):
+    def _open_output(self, out, name):
+        """ Return `stdout`/`stderr` argument for the child process
+
+        Files and DEVNULL are given to the child directly, so output doesn't pass through Python at all
+        (unless the stream is watched)
+        """
+        if out is None or isinstance(out, logging.Logger) or self._watchers[name]:
+            return asyncio.subprocess.PIPE
+        if out == subprocess.DEVNULL:
+            self._direct[name] = "DEVNULL"
+            return subprocess.DEVNULL
+        if isinstance(out, str):
+            f = open(out, "wb")
+            self._opened.append(f)
+            self._direct[name] = f"file ({out})"
+            return f.fileno()
+        fd = _fileno(out)
+        if fd is not None:
+            self._direct[name] = f"FileObject ({out})"
+            return fd
+        if hasattr(out, "write"):
+            return asyncio.subprocess.PIPE
+        raise RuntimeError(f"invalid 'out' argument: {out}")
+
+    def __init__(self, args, cwd, logger, stdout=None, stderr=None, rusage=False, log_usage=False, watchers=(),
+                 new_session=False, input=None, env=None):
+        """
+        `input` - bytes written to STDIN of the process (DEVNULL if None)
+        `env` - environment variables set for the process on top of the inherited ones
+        `rusage` - run the command via a tiny wrapper collecting CPU, memory and I/O usage
+        `log_usage` - log resource usage when the process finishes
+        `watchers` - `Watcher`s of the output, the process gets its own process group if any of them aborts
+        `new_session` - run the process in its own session, so `terminate` stops the whole process tree
+        """
         self.logger = logger
         self._args = args
         self._cwd = cwd
         self._proc = None
+        self._rusage = rusage
+        self._rusage_fd = None
+        self._log_usage = log_usage
+        self._started = None
+        self.usage = None
+        self._stdout = stdout
+        self._stderr = stderr
+        self._input = input
+        self._env = env
+        self._pumps = []
+        self._redirected = set()  # pipes which are being pumped
+        self._opened = []
+        self._direct = {}
+        self._watchers = {
+            name: [w for w in watchers if name in w.streams] for name in (self.STDOUT, self.STDERR)
+        }
+        self._tails = {self.STDOUT: b"", self.STDERR: b""}
+        self._new_session = new_session or any(w.abort for w in watchers)
+        # the rusage wrapper can't forward SIGKILL, so it's sent to the group of the wrapper and the command
+        self._own_group = self._new_session or rusage
+        self.aborted = None  # (watcher, matched text) if a watcher has aborted the process
 
     @property
     def pid(self):
@@ -85,38 +306,153 @@ class Process:
 
     async def _run(self):
         self.logger.debug(f"Run command {self._args} with workdir={self._cwd} ...")
-        self._proc = await asyncio.create_subprocess_exec(
-            *self._args,
-            stdin=asyncio.subprocess.DEVNULL,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-            cwd=self._cwd
-        )
+        args = self._args
+        pass_fds = ()
+        if self._rusage:
+            self._rusage_fd, wfd = os.pipe()
+            args = [sys.executable, "-I", "-S", _RUSAGE_WRAPPER, str(wfd), *args]
+            pass_fds = (wfd, )
+            self._opened.append(os.fdopen(wfd, "wb"))
+
+        self._started = time.monotonic()
+        try:
+            self._proc = await asyncio.create_subprocess_exec(
+                *args,
+                stdin=asyncio.subprocess.DEVNULL if self._input is None else asyncio.subprocess.PIPE,
+                stdout=self._open_output(self._stdout, self.STDOUT),
+                stderr=self._open_output(self._stderr, self.STDERR),
+                cwd=self._cwd,
+                env=None if self._env is None else dict(os.environ, **self._env),
+                pass_fds=pass_fds,
+                start_new_session=self._own_group  # to kill the whole tree at once
+            )
+        except BaseException:
+            if self._rusage_fd is not None:
+                os.close(self._rusage_fd)
+                self._rusage_fd = None
+            raise
+        finally:
+            for f in self._opened:
+                f.close()  # the child has its own copy of the descriptor
+        PROCESSES_RUNNING.inc()
         self.logger.info(f"Command {self._args} with workdir={self._cwd} started a process with PID={self._proc.pid}")
+        if self._input is not None:
+            self._pumps.append(asyncio.create_task(self._feed()))
+        for name, dst in self._direct.items():
+            self.logger.info(f"Redirect {name} of process PID={self.pid} to {dst}")
+
+    async def _feed(self):
+        try:
+            self._proc.stdin.write(self._input)
+            await self._proc.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # the process doesn't read all of its input
+        finally:
+            self._proc.stdin.close()
+
+    async def _drain(self):
+        """ Wait until output of the finished process is completely pumped """
+        if not self._pumps:
+            return
+        done, pending = await asyncio.wait(self._pumps, timeout=_DRAIN_TIMEOUT)
+        if pending:
+            self.logger.warning(f"Output of process PID={self.pid} is still open (inherited by a daemon?), stop reading it")
+            for task in pending:
+                task.cancel()
+        self._pumps = []
 
     async def _wait(self, noexcept=False, noredirect=False, timeout=None, stdout=None, stderr=None):
+        # a fast process may have been reaped already, its output is still in the pipes
+        if not noredirect:
+            if self._proc.stdout is not None and self.STDOUT not in self._redirected:
+                self._redirect_output(self._proc.stdout, stdout or self._stdout or self.logger)
+            if self._proc.stderr is not None and self.STDERR not in self._redirected:
+                self._redirect_output(self._proc.stderr, stderr or self._stderr or self.logger)
+
         retcode = self._proc.returncode
         if retcode is None:
-            if not noredirect:
-                self._redirect_output(self._proc.stdout, self.logger if stdout is None else stdout)
-                self._redirect_output(self._proc.stderr, self.logger if stderr is None else stderr)
-
             try:
                 retcode = await asyncio.wait_for(self._proc.wait(), timeout=timeout)
             except asyncio.TimeoutError:
                 self.logger.warning(f"Process PID={self.pid} didn't finish in {timeout} secconds")
                 raise
+        await self._drain()
+
+        if self.usage is None:
+            self._finish(retcode)
 
         self.logger.info(f"Process PID={self.pid} finished with code {retcode}")
         if noexcept or retcode == 0:
-            return retcode
+            return ProcessResult(retcode, self.usage)
+        if self.aborted is not None:
+            raise ProcessAborted(*self.aborted)
         raise RuntimeError(f"command failed with code = {retcode}")
 
+    def _finish(self, retcode):
+        """ Collect resource usage and account the process in metrics, once """
+        self.usage = self._collect_usage()
+        PROCESSES_RUNNING.dec()
+        status = "ok" if retcode == 0 else ("aborted" if self.aborted is not None else "failed")
+        PROCESS_SECONDS.labels(os.path.basename(self._args[0]), status).observe(self.usage.wall_time)
+        if self._log_usage:
+            self.logger.info(f"Process PID={self.pid} resource usage: {self.usage}")
+
+    def _collect_usage(self):
+        usage = ResourceUsage(wall_time=time.monotonic() - self._started)
+        if self._rusage_fd is None:
+            return usage
+
+        # the wrapper has exited, so the whole report is in the pipe already
+        os.set_blocking(self._rusage_fd, False)
+        data = b""
+        try:
+            while True:
+                chunk = os.read(self._rusage_fd, 4096)
+                if not chunk:
+                    break
+                data += chunk
+        except BlockingIOError:
+            pass
+        finally:
+            os.close(self._rusage_fd)
+            self._rusage_fd = None
+
+        try:
+            usage.__dict__.update(json.loads(data))
+        except ValueError:
+            self.logger.warning(f"No resource usage reported for process PID={self.pid}")
+        return usage
+
+    def _watch(self, name, chunk):
+        if not chunk or self.aborted is not None:
+            return
+        # the unterminated line of the previous chunk is scanned again, so it may complete a match
+        tail = self._tails[name]
+        data = tail + chunk
+        for watcher in self._watchers[name]:
+            watcher._scan(data, len(tail), self, name)
+            if self.aborted is not None:
+                return
+        end = data.rfind(b"\n")
+        self._tails[name] = data[end + 1:][-_MAX_LINE:]
+
+    def abort(self, watcher, match, stream):
+        """ Kill the process tree right away """
+        text = match.group(0).decode("utf-8", errors="ignore")
+        self.aborted = (watcher, text)
+        self.logger.warning(f"{stream} of process PID={self.pid} matched {watcher.regex.pattern!r}: {text!r}, "
+                            f"kill the process tree")
+        try:
+            os.killpg(self.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
     async def exec(self, noexcept=False, timeout=None, stdout=None, stderr=None):
         return await self._wait(noexcept=noexcept, timeout=timeout, stdout=stdout, stderr=stderr)
 
     async def read_stdout_until(self, separator=b"\n", raw=False, stderr=None, timeout=None, noexcept=False):
-        self._redirect_output(self._proc.stderr, out=self.logger if stderr is None else stderr)
+        if self._proc.stderr is not None and self.STDERR not in self._redirected:
+            self._redirect_output(self._proc.stderr, out=stderr or self._stderr or self.logger)
 
         eof = False
         while not eof:
@@ -127,6 +463,8 @@ class Process:
                 eof = True
             if not chunk:
                 break  # no more output in STDOUT
+            if self._watchers[self.STDOUT]:
+                self._watch(self.STDOUT, chunk)
             if not raw:
                 chunk = chunk[:-len(separator)].decode("utf-8", errors="ignore")
             self.logger.debug(f"[PID={self.pid}, {self.STDOUT}] {chunk}")
@@ -140,14 +478,20 @@ class Process:
             yield line
 
     async def terminate(self, timeout=10):
-        self._proc.terminate()
+        if self._new_session:
+            os.killpg(self.pid, signal.SIGTERM)
+        else:
+            self._proc.terminate()
         try:
             self.logger.warning(f"Terminate process PID={self.pid} ...")
             return await self._wait(noexcept=True, noredirect=True, timeout=timeout)
         except asyncio.TimeoutError:
             self.logger.warning(f"Could not terminate process PID={self.pid}, try to kill it...")
 
-        self._proc.kill()
+        if self._own_group:
+            os.killpg(self.pid, signal.SIGKILL)
+        else:
+            self._proc.kill()
         try:
             self.logger.warning(f"Kill process PID={self.pid} ...")
             return await self._wait(noexcept=True, noredirect=True, timeout=timeout)
@@ -157,14 +501,25 @@ class Process:
 
 # -------------------------------------------------------------------------------------------------
 class Command:
-    def __init__(self, logger=None):
+    def __init__(self, logger=None, rusage=False, log_usage=False, new_session=False):
+        """
+        `rusage` - collect CPU, memory and I/O usage of every process (costs an extra interpreter start)
+        `log_usage` - log resource usage summary of every process
+        `new_session` - run every process in its own session, terminating it stops the whole tree
+        """
         self.logger = logger or logging.getLogger()
-
-    def run(self, args, cwd=None):
-        return Process(args, cwd, self.logger)
+        self.rusage = rusage
+        self.log_usage = log_usage
+        self.new_session = new_session
+
+    def run(self, args, cwd=None, stdout=None, stderr=None, watchers=(), input=None, env=None):
+        return Process(args, cwd, self.logger, stdout=stdout, stderr=stderr, rusage=self.rusage,
+                       log_usage=self.log_usage, watchers=watchers, new_session=self.new_session, input=input,
+                       env=env)
     
-    async def exec(self, args, cwd=None, **kwargs):
-        """
+    async def exec(self, args, cwd=None, stdout=None, stderr=None, watchers=(), input=None, env=None, **kwargs):
+        """ Run a process and wait for it, return `ProcessResult` (return code with resource usage)
+
         Extra kwargs:
         `noexcept` - do not raise exception if running process is failed
         `timeout` - timeout for process completion (raise asyncio.TimeoutError)
@@ -173,15 +528,21 @@ class Command:
             subprocess.DEVNULL - drop output to nowhere
             <file name> - write ouput as-is into a file
             File-like object (with `write` method) - write to it
+        Files and file objects backed by a descriptor are passed to the process directly
+        `watchers` - `Watcher`s of the output, e.g. to abort the process on a fatal error message
+        `input` - bytes to write to STDIN
+        `env` - extra environment variables of the process
         """
-        async with self.run(args, cwd) as proc:
+        async with self.run(args, cwd, stdout=stdout, stderr=stderr, watchers=watchers, input=input,
+                            env=env) as proc:
             return await proc.exec(**kwargs)
 
     async def read_stdout(self, args, cwd=None, **kwargs):
         async for line in self.read_stdout_until(args, separator=b"\n", cwd=cwd, **kwargs):
             yield line
 
-    async def read_stdout_until(self, args, separator=b"\n", cwd=None, **kwargs):
+    async def read_stdout_until(self, args, separator=b"\n", cwd=None, stderr=None, watchers=(), input=None,
+                                env=None, **kwargs):
         """ Async generator of lines obtained from STDOUT
 
         Extra kwargs:
@@ -193,8 +554,11 @@ class Command:
             subprocess.DEVNULL - drop output to nowhere
             <file name> - write ouput as-is into a file
             File-like object (with `write` method) - write to it
+        `watchers` - `Watcher`s of the output
+        `input` - bytes to write to STDIN
+        `env` - extra environment variables of the process
         """
-        async with self.run(args, cwd) as proc:
+        async with self.run(args, cwd, stderr=stderr, watchers=watchers, input=input, env=env) as proc:
             async for chunk in proc.read_stdout_until(separator=separator, **kwargs):
                 yield chunk
 
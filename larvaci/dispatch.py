@@ -0,0 +1,321 @@
+""" Coordinator/worker split of PR processing over TCP or Unix sockets
+
+The protocol is newline-delimited JSON, every message has an "op" field:
+    worker -> coordinator: pull {flows, token}, heartbeat {job_id}, status {job_id, message}, result {job_id, result}
+    coordinator -> worker: job {job_id, flow, pr, attempt}, idle (answers to pull) or denied (wrong token)
+
+Jobs are leased to a worker until it sends the result. A lease is returned to the queue when the worker
+disconnects, stops sending heartbeats or reports `RES_WORKER_ERROR`. A TCP coordinator requires workers to
+present a shared token in the first message of a connection, a Unix socket is protected by its file permissions.
+"""
+import hmac
+import json
+import time
+import asyncio
+import logging
+import itertools
+from collections import deque
+
+from .log import current_pr
+
+RES_WORKER_ERROR = "worker_error"  # the worker failed before it could process the PR, run the job elsewhere
+
+
+def parse_address(address):
+    """ `unix:/path/to/socket` or `host:port` (`:port` is localhost) """
+    if address.startswith("unix:"):
+        return ("unix", address[len("unix:"):])
+    host, _, port = address.rpartition(":")
+    return ("tcp", (host or "127.0.0.1", int(port)))
+
+
+async def _send(writer, **msg):
+    writer.write(json.dumps(msg).encode("utf-8") + b"\n")
+    await writer.drain()
+
+
+async def _recv(reader):
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError("connection closed")
+    return json.loads(line)
+
+
+class Job:
+    def __init__(self, job_id, flow, pr, attempt, future):
+        self.job_id = job_id
+        self.flow = flow
+        self.pr = pr
+        self.attempt = attempt
+        self.future = future
+        self.worker_errors = 0
+        self.owner = None  # id of the connection holding the lease
+        self.deadline = None
+        self.queued_at = time.monotonic()
+
+
+# -------------------------------------------------------------------------------------------------
+class Coordinator:
+    def __init__(self, token=None, lease_timeout=60, pull_timeout=30, queue_timeout=3600, max_worker_errors=3,
+                 logger=None):
+        """
+        `token` - secret workers must present, required to listen on TCP
+        `lease_timeout` - seconds without heartbeat or status after which a job goes back to the queue
+        `pull_timeout` - how long a worker's pull waits for a job before getting `idle`
+        `queue_timeout` - seconds a job may wait for a worker, `submit` fails after that
+        `max_worker_errors` - `submit` fails after the job has got that many `RES_WORKER_ERROR` results
+        """
+        self.token = token
+        self.lease_timeout = lease_timeout
+        self.pull_timeout = pull_timeout
+        self.queue_timeout = queue_timeout
+        self.max_worker_errors = max_worker_errors
+        self.logger = logger or logging.getLogger()
+        self._queue = deque()
+        self._leases = {}
+        self._counter = itertools.count()
+        self._connections = itertools.count()
+        self._cond = asyncio.Condition()
+        self._server = None
+        self._expiry_task = None
+
+    @property
+    def queue_size(self):
+        return len(self._queue)
+
+    async def start(self, address):
+        kind, addr = parse_address(address)
+        if kind == "unix":
+            self._server = await asyncio.start_unix_server(self._handle, path=addr)
+        else:
+            if not self.token:
+                raise RuntimeError(f"coordinator on TCP address {address} requires a token")
+            self._server = await asyncio.start_server(self._handle, host=addr[0], port=addr[1])
+        self._expiry_task = asyncio.create_task(self._expire_leases())
+        self.logger.info(f"Coordinator is listening on {address}")
+
+    async def stop(self):
+        if self._expiry_task is not None:
+            self._expiry_task.cancel()
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def submit(self, flow, pr, attempt):
+        """ Queue PR revision for remote processing, return the result reported by a worker """
+        future = asyncio.get_event_loop().create_future()
+        job = Job(next(self._counter), flow, pr, attempt, future)
+        async with self._cond:
+            self._queue.append(job)
+            self._cond.notify_all()
+        try:
+            return await future
+        finally:
+            self._forget(job)
+
+    def _forget(self, job):
+        self._leases.pop(job.job_id, None)
+        if job in self._queue:
+            self._queue.remove(job)
+
+    def _owned(self, job_id, conn):
+        """ Leased job `job_id` if connection `conn` holds its lease, None otherwise """
+        job = self._leases.get(job_id)
+        if job is None or job.owner != conn:
+            return None
+        return job
+
+    async def _requeue(self, jobs, reason):
+        async with self._cond:
+            for job in jobs:
+                if job.future.done() or self._leases.get(job.job_id) is not job:
+                    continue
+                self.logger.warning(f"Job {job.job_id} (flow {job.flow}) is returned to the queue: {reason}")
+                del self._leases[job.job_id]
+                job.owner = None
+                job.queued_at = time.monotonic()
+                self._queue.appendleft(job)
+            self._cond.notify_all()
+
+    async def _expire_leases(self):
+        while True:
+            await asyncio.sleep(1)
+            now = time.monotonic()
+            expired = [job for job in self._leases.values() if job.deadline < now]
+            if expired:
+                await self._requeue(expired, "lease expired")
+            for job in list(self._queue):
+                if job.queued_at + self.queue_timeout < now and not job.future.done():
+                    job.future.set_exception(RuntimeError(
+                        f"no worker has taken job {job.job_id} (flow {job.flow}) in {self.queue_timeout} seconds"))
+
+    def _take(self, flows):
+        for job in self._queue:
+            if job.flow in flows:
+                self._queue.remove(job)
+                return job
+        return None
+
+    async def _worker_error(self, job, worker):
+        job.worker_errors += 1
+        if job.worker_errors < self.max_worker_errors:
+            await self._requeue([job], f"worker {worker} has failed to run it")
+        elif not job.future.done():
+            job.future.set_exception(RuntimeError(
+                f"job {job.job_id} (flow {job.flow}) has failed {job.worker_errors} times on workers"))
+
+    async def _lease(self, conn, flows):
+        async with self._cond:
+            try:
+                job = await asyncio.wait_for(self._cond.wait_for(lambda: self._take(flows)), self.pull_timeout)
+            except asyncio.TimeoutError:
+                return None
+        job.owner = conn
+        job.deadline = time.monotonic() + self.lease_timeout
+        self._leases[job.job_id] = job
+        return job
+
+    async def _handle(self, reader, writer):
+        conn = next(self._connections)
+        worker = f"{writer.get_extra_info('peername') or 'unix socket'} #{conn}"
+        self.logger.info(f"Worker {worker} has connected")
+        try:
+            msg = await _recv(reader)
+            if self.token and not hmac.compare_digest(str(msg.get("token")), self.token):
+                self.logger.warning(f"Worker {worker} has presented a wrong token, disconnect it")
+                await _send(writer, op="denied")
+                return
+            while True:
+                op = msg.get("op")
+                if op == "pull":
+                    job = await self._lease(conn, set(msg["flows"]))
+                    if job is None:
+                        await _send(writer, op="idle")
+                        continue
+                    self.logger.info(f"Job {job.job_id} (flow {job.flow}, PR {job.pr['id']}) is leased to {worker}")
+                    await _send(writer, op="job", job_id=job.job_id, flow=job.flow, pr=job.pr, attempt=job.attempt)
+                elif op in ("heartbeat", "status"):
+                    job = self._owned(msg["job_id"], conn)
+                    if job is not None:
+                        job.deadline = time.monotonic() + self.lease_timeout
+                        if op == "status":
+                            self.logger.info(f"Job {job.job_id} on {worker}: {msg['message']}")
+                elif op == "result":
+                    job = self._owned(msg["job_id"], conn)
+                    if job is None:
+                        self.logger.warning(f"Result of job {msg['job_id']} from {worker} is ignored, "
+                                            f"the worker does not hold its lease anymore")
+                    elif msg["result"] == RES_WORKER_ERROR:
+                        await self._worker_error(job, worker)
+                    elif not job.future.done():
+                        self.logger.info(f"Job {job.job_id} is finished by {worker}, result={msg['result']}")
+                        job.future.set_result(msg["result"])
+                else:
+                    self.logger.warning(f"Unknown message from worker {worker}: {msg}")
+                msg = await _recv(reader)
+        except (ConnectionError, ValueError) as err:
+            self.logger.warning(f"Worker {worker} has disconnected: {err}")
+        except asyncio.CancelledError:
+            pass  # coordinator is stopping
+        finally:
+            writer.close()
+            owned = [job for job in self._leases.values() if job.owner == conn]
+            await self._requeue(owned, f"worker {worker} is lost")
+
+
+# -------------------------------------------------------------------------------------------------
+class _StatusHandler(logging.Handler):
+    """ Queues the flow's own records about PR `pr_id` for the coordinator, process output only if it is a warning """
+
+    def __init__(self, pr_id, queue):
+        super().__init__(logging.INFO)
+        self.pr_id = pr_id
+        self.queue = queue
+
+    def emit(self, record):
+        if current_pr.get() != self.pr_id or (hasattr(record, "pid") and record.levelno < logging.WARNING):
+            return
+        try:
+            self.queue.put_nowait(record.getMessage())
+        except asyncio.QueueFull:
+            pass  # the coordinator is too slow to read it, the local log has everything
+
+
+class Worker:
+    """ Connection to a coordinator running jobs of local `flows` (name -> flow) one by one """
+
+    def __init__(self, flows, address, token=None, index=0, heartbeat=10, reconnect_delay=5, logger=None):
+        """
+        `token` - secret of the coordinator
+        `index` - number of the worker within the process, it selects the flow's checkout
+        """
+        self.flows = flows
+        self.address = address
+        self.token = token
+        self.index = index
+        self.heartbeat = heartbeat
+        self.reconnect_delay = reconnect_delay
+        self.logger = logger or logging.getLogger()
+
+    async def _connect(self):
+        kind, addr = parse_address(self.address)
+        if kind == "unix":
+            return await asyncio.open_unix_connection(addr)
+        return await asyncio.open_connection(addr[0], addr[1])
+
+    async def _report(self, writer, job_id, statuses):
+        """ Send status messages as they come, a heartbeat when there were none for `self.heartbeat` seconds """
+        while True:
+            try:
+                message = await asyncio.wait_for(statuses.get(), self.heartbeat)
+            except asyncio.TimeoutError:
+                await _send(writer, op="heartbeat", job_id=job_id)
+            else:
+                await _send(writer, op="status", job_id=job_id, message=message)
+
+    async def _run_job(self, writer, msg):
+        job_id = msg["job_id"]
+        flow = self.flows[msg["flow"]]
+        await _send(writer, op="status", job_id=job_id, message=f"started (attempt {msg['attempt']})")
+
+        statuses = asyncio.Queue(maxsize=1000)
+        status_handler = _StatusHandler(msg["pr"]["id"], statuses)
+        flow.logger.addHandler(status_handler)
+        pr_token = current_pr.set(msg["pr"]["id"])
+        reporter = asyncio.create_task(self._report(writer, job_id, statuses))
+        try:
+            result = await flow.run_job(self.index, msg["pr"], msg["attempt"])
+        except Exception:
+            self.logger.exception(f"Job {job_id} has failed on the worker")
+            result = RES_WORKER_ERROR
+        finally:
+            current_pr.reset(pr_token)
+            flow.logger.removeHandler(status_handler)
+            reporter.cancel()
+        while not statuses.empty():
+            await _send(writer, op="status", job_id=job_id, message=statuses.get_nowait())
+        await _send(writer, op="result", job_id=job_id, result=result)
+
+    async def run(self):
+        while True:
+            try:
+                reader, writer = await self._connect()
+            except OSError as err:
+                self.logger.warning(f"Could not connect to coordinator {self.address}: {err}")
+                await asyncio.sleep(self.reconnect_delay)
+                continue
+
+            self.logger.info(f"Worker {self.index} is connected to coordinator {self.address}")
+            try:
+                while True:
+                    await _send(writer, op="pull", flows=list(self.flows), token=self.token)
+                    msg = await _recv(reader)
+                    if msg["op"] == "denied":
+                        raise ConnectionError("the coordinator has denied the token")
+                    if msg["op"] == "job":
+                        await self._run_job(writer, msg)
+            except (ConnectionError, ValueError) as err:
+                self.logger.warning(f"Connection to coordinator {self.address} is lost: {err}")
+            finally:
+                writer.close()
+            await asyncio.sleep(self.reconnect_delay)
@@ -6,21 +6,38 @@ import asyncio
 from .command import Command
 from .git import Git
 from .github import GitHubClient
+from .scheduler import NO_SLOT
+from .metrics import Counter, Gauge, Histogram
+from .trace import Trace, span
 
 
 _CONTEXT_FNAME = "context.json"
+_TRACE_FNAME = "trace.json"
+
+FLOW_ITERATION_SECONDS = Histogram("larvaci_flow_iteration_seconds", "Duration of flow iterations", labels=("flow", ))
+FLOW_ITERATION_FAILURES = Counter("larvaci_flow_iteration_failures_total", "Flow iterations failed with an exception",
+                                  labels=("flow", ))
+FLOW_LAST_ITERATION = Gauge("larvaci_flow_last_iteration_timestamp_seconds",
+                            "Unix time the last iteration of flow has finished at", labels=("flow", ))
 
 
 class FlowBase:
     delay = 60
+    max_delay = 60  # set above `delay` to poll less often while the flow is idle
+    backoff = 2  # growth factor of the delay after an idle iteration
+    rusage = False  # collect and log resource usage of processes run via `self.command`
+    trace = False  # write Chrome trace of the last iteration into workdir (and of every PR run into its rundir)
 
-    def __init__(self, workdir, logger, github_token):
+    def __init__(self, workdir, logger, github_token, github_session=None, github_url=None):
         self.workdir = workdir
         self.logger = logger
-        self.command = Command(logger=self.logger)
+        self.command = Command(logger=self.logger, rusage=self.rusage, log_usage=self.rusage)
         self.git = Git(logger=self.logger)
-        self.github = GitHubClient(token=github_token, logger=self.logger)
+        self.github = GitHubClient(token=github_token, logger=self.logger, session=github_session, url=github_url)
         self.context = {}
+        self.scheduler = None  # process-wide larvaci.scheduler.Scheduler, set by main_loop
+        self.active = False  # set by run() if the iteration has done anything useful
+        self._wakeup = None
 
         self._context_path = os.path.join(self.workdir, _CONTEXT_FNAME)
         if os.path.exists(self._context_path):
@@ -32,33 +49,88 @@ class FlowBase:
     def name(self):
         return self.__class__.__name__
 
+    def wakeup(self):
+        """ Start the next iteration immediately """
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def job_slot(self, cpus=1, memory=0, priority=0, name=None):
+        """ Async context manager waiting for free CPU/memory slots of the shared scheduler (if any) """
+        if self.scheduler is None:
+            return NO_SLOT
+        return self.scheduler.slot(cpus=cpus, memory=memory, priority=priority, name=name or self.name)
+
+    def match_webhook(self, event, payload):
+        """ Return True if GitHub webhook `event` with `payload` concerns this flow """
+        return False
+
+    async def _sleep(self, delay):
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            logging.info(f"Flow {self.name} has been woken up")
+        except asyncio.TimeoutError:
+            pass
+
+    def background_tasks(self):
+        """ Coroutines running alongside the flow's loop, they are cancelled when the flow stops """
+        return []
+
     def shutdown(self):
         with open(self._context_path, "w") as f:
             json.dump(self.context, f)
         logging.info(f"Context of {self.name} flow is saved")
     
     async def _run(self, *args, **kwargs):
+        self._wakeup = asyncio.Event()
+        delay = self.delay
+        background = [asyncio.create_task(coro) for coro in self.background_tasks()]
         try:
             while True:
                 logging.debug(f"Run {self.name} flow...")
 
+                woken = self._wakeup.is_set()
+                self._wakeup.clear()
+                self.active = False
                 t0 = time.monotonic()
                 try:
-                    await self.run(*args, **kwargs)
+                    await self._traced_run(*args, **kwargs)
                 except asyncio.CancelledError:
                     raise
                 except Exception as err:
+                    FLOW_ITERATION_FAILURES.labels(self.name).inc()
                     logging.exception(f"Flow {self.name} has failed with an exception")
                 dur = time.monotonic() - t0
+                FLOW_ITERATION_SECONDS.labels(self.name).observe(dur)
+                FLOW_LAST_ITERATION.labels(self.name).set(time.time())
+
+                if woken or self.active:
+                    delay = self.delay
+                else:
+                    delay = min(delay * self.backoff, self.max_delay)
 
-                logging.info(f"Flow {self.name} has finished in {dur} seconds")
-                await asyncio.sleep(self.delay)
+                logging.info(f"Flow {self.name} has finished in {dur} seconds, next run in {delay} seconds")
+                await self._sleep(delay)
         except asyncio.CancelledError:
             logging.info(f"Flow {self.name} has been stopped")
         except BaseException as err:
             logging.exception(f"Flow {self.name} has epically crashed with an exception")
 
+        for task in background:
+            task.cancel()
+        await asyncio.gather(*background, return_exceptions=True)
         self.shutdown()
+        await self.github.close()
+
+    async def _traced_run(self, *args, **kwargs):
+        if not self.trace:
+            return await self.run(*args, **kwargs)
+
+        trace = Trace(name=f"{self.name} iteration")
+        try:
+            with trace.activate(), span("iteration", cat="flow", flow=self.name):
+                await self.run(*args, **kwargs)
+        finally:
+            trace.write(os.path.join(self.workdir, _TRACE_FNAME))
 
     async def run(self):
         raise NotImplementedError("run() must be implemented in sublcasses")
@@ -1,26 +1,104 @@
 from .command import Command
+from .trace import span
+
+# a partial clone would download every missing object it is asked about (git 2.44+ honors it)
+_NO_LAZY_FETCH = {"GIT_NO_LAZY_FETCH": "1"}
 
 
 class Git:
-    def __init__(self, git_path="git", logger=None):
+    def __init__(self, git_path="git", logger=None, keep_paths=()):
+        """
+        `keep_paths` - patterns of untracked paths `clean` keeps by default (build dirs, caches, venvs)
+        """
         self.git_path = git_path
         self.cmd = Command(logger=logger)
+        self.keep_paths = keep_paths
 
     async def run(self, args, cwd=None):
-        args.insert(0, self.git_path)
-        await self.cmd.exec(args, cwd=cwd)
+        with span(f"git {args[0]}", cat="git"):
+            args.insert(0, self.git_path)
+            await self.cmd.exec(args, cwd=cwd)
+
+    async def output(self, args, cwd=None):
+        """ Run git command and return its STDOUT lines """
+        with span(f"git {args[0]}", cat="git"):
+            args.insert(0, self.git_path)
+            return [line async for line in self.cmd.read_stdout(args, cwd=cwd)]
 
-    async def clone(self, url, dst_dir, branch=None):
-        return await self.run(["clone", url, dst_dir])
+    async def clone(self, url, dst_dir, branch=None, filter=None, depth=None, sparse=False):
+        """
+        `filter` - partial clone filter, e.g. "blob:none" downloads file contents only when they are checked out
+        `depth` - number of commits to download from the tip of every branch
+        `sparse` - check out only files in the root directory, see `sparse_checkout`
+        """
+        args = ["clone"]
+        if branch is not None:
+            args += ["--branch", branch]
+        if filter is not None:
+            args.append(f"--filter={filter}")
+        if depth is not None:
+            args += ["--depth", str(depth), "--no-single-branch"]
+        if sparse:
+            args.append("--sparse")
+        return await self.run(args + [url, dst_dir])
 
-    async def clean(self, repo_dir):
-        return await self.run(["clean", "--force", "-d", "-x"], cwd=repo_dir)
+    async def sparse_checkout(self, repo_dir, paths):
+        """ Check out only `paths` (directories) in the repository or worktree """
+        return await self.run(["sparse-checkout", "set", *paths], cwd=repo_dir)
+
+    async def clean(self, repo_dir, keep=None):
+        """ Remove untracked and ignored files except `keep` patterns (`keep_paths` by default) """
+        args = ["clean", "--force", "-d", "-x"]
+        for pattern in (self.keep_paths if keep is None else keep):
+            args += ["-e", pattern]  # -x ignores .gitignore rules, but not ones given with -e
+        return await self.run(args, cwd=repo_dir)
 
     async def checkout(self, repo_dir, revision):
         return await self.run(["checkout", "--force", revision], cwd=repo_dir)
 
-    async def fetch(self, repo_dir):
-        return await self.run(["fetch", "--force"], cwd=repo_dir)
+    async def fetch(self, repo_dir, depth=None):
+        args = ["fetch", "--force"]
+        if depth is not None:
+            args += ["--depth", str(depth)]
+        return await self.run(args, cwd=repo_dir)
+
+    async def has_commit(self, repo_dir, oid):
+        return not await self.missing_commits(repo_dir, [oid])
+
+    async def missing_commits(self, repo_dir, oids):
+        """ Return `oids` which aren't commits of the repository, all of them are checked by one git invocation """
+        oids = list(dict.fromkeys(oids))
+        if not oids:
+            return []
+        args = [self.git_path, "cat-file", "--batch-check=%(objectname) %(objecttype)"]
+        input = "".join(f"{oid}\n" for oid in oids).encode("utf-8")
+        with span("git cat-file", cat="git"):
+            lines = [line async for line in self.cmd.read_stdout(args, cwd=repo_dir, input=input,
+                                                                 env=_NO_LAZY_FETCH)]
+        # "<oid> commit" for present objects, "<oid> missing" for absent ones
+        present = {line.split()[0] for line in lines if line.endswith(" commit")}
+        return [oid for oid in oids if oid not in present]
+
+    async def fetch_commits(self, repo_dir, oids, refspecs=(), remote="origin", depth=None):
+        """ Fetch commits `oids` missing in the repository with one git invocation, return the missing ones
+
+        Servers that don't allow to fetch commits by hash get `refspecs` instead (e.g. refs/pull/N/head and the
+        base branches).
+        """
+        missing = await self.missing_commits(repo_dir, oids)
+        if not missing:
+            return missing
+
+        args = ["fetch", "--force", "--no-tags"]
+        if depth is not None:
+            args += ["--depth", str(depth)]
+        try:
+            await self.run(args + [remote, *missing], cwd=repo_dir)
+        except RuntimeError:
+            if not refspecs:
+                raise
+            await self.run(args + [remote, *refspecs], cwd=repo_dir)
+        return missing
 
     async def submodule_init(self, repo_dir):
         return await self.run(["submodule", "update", "--init", "--recursive"], cwd=repo_dir)
@@ -30,3 +108,37 @@ class Git:
 
     async def merge(self, repo_dir, revision):
         return await self.run(["merge", "--squash", revision], cwd=repo_dir)
+
+    async def mirror(self, url, dst_dir, filter=None):
+        args = ["clone", "--mirror"]
+        if filter is not None:
+            args.append(f"--filter={filter}")
+        return await self.run(args + [url, dst_dir])
+
+    async def worktree_add(self, repo_dir, worktree_dir, revision, checkout=True):
+        args = ["worktree", "add", "--force", "--detach"]
+        if not checkout:
+            args.append("--no-checkout")  # e.g. to set up sparse checkout first
+        return await self.run(args + [worktree_dir, revision], cwd=repo_dir)
+
+    async def worktree_remove(self, repo_dir, worktree_dir):
+        return await self.run(["worktree", "remove", "--force", worktree_dir], cwd=repo_dir)
+
+    async def worktree_prune(self, repo_dir):
+        return await self.run(["worktree", "prune"], cwd=repo_dir)
+
+    async def merge_tree(self, repo_dir, base, head):
+        """ Hash of the tree `merge` of `head` into `base` would produce, None if they conflict
+
+        Needs git 2.38+, works in bare repositories, doesn't touch the index or the working tree
+        """
+        try:
+            lines = await self.output(["merge-tree", "--write-tree", "--no-messages", base, head], cwd=repo_dir)
+        except RuntimeError:
+            return None
+        return lines[0] if lines else None
+
+    async def write_tree(self, repo_dir):
+        """ Hash of the tree in the index, e.g. right after `merge` """
+        lines = await self.output(["write-tree"], cwd=repo_dir)
+        return lines[0]
@@ -2,49 +2,268 @@ import os
 import json
 import logging
 import aiohttp
+import time
+import random
 import asyncio
+import itertools
+from collections import OrderedDict
+from .metrics import Counter, Histogram
+from .trace import span
 
 
 GITHUB_API_URL="https://api.github.com/graphql"
 
+GITHUB_REQUEST_SECONDS = Histogram("larvaci_github_request_seconds", "Latency of GitHub API request attempts",
+                                   labels=("outcome", ))
+GITHUB_REQUEST_ERRORS = Counter("larvaci_github_request_errors_total", "Failed GitHub API request attempts")
+GITHUB_REQUEST_RETRIES = Counter("larvaci_github_request_retries_total", "Retried GitHub API requests")
+GITHUB_CIRCUIT_REJECTIONS = Counter("larvaci_github_circuit_rejections_total",
+                                    "GitHub API requests failed fast because of the open circuit breaker")
+
+_OPERATIONS = ("pullRequests", "addComment", "updateIssueComment", "repository")
+
+
+def _operation(query):
+    """ Name of GraphQL operation for traces """
+    if "m0:" in query["query"]:
+        return "batch"
+    if "r0:" in query["query"]:
+        return "batch pullRequests"
+    return next((op for op in _OPERATIONS if op in query["query"]), "query")
+
+
+class GitHubError(RuntimeError):
+    """ GitHub API request has failed, `retryable` if it may succeed later (in `retry_after` seconds if known) """
+
+    def __init__(self, message, status=None, errors=None, retryable=False, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.errors = errors
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+
+class RateLimitError(GitHubError):
+    pass
+
+
+class CircuitOpenError(GitHubError):
+    pass
+
+
+def _retry_after(headers):
+    """ Seconds to wait according to Retry-After or X-RateLimit-Reset headers, None if there are none """
+    try:
+        if "Retry-After" in headers:
+            return max(0.0, float(headers["Retry-After"]))
+        if "X-RateLimit-Reset" in headers:
+            return max(0.0, float(headers["X-RateLimit-Reset"]) - time.time())
+    except ValueError:
+        pass
+    return None
+
+
+def _field(resp, name):
+    """ Top-level field of response data, GitHubError with the reported errors if it's missing """
+    value = (resp.get("data") or {}).get(name)
+    if value is None:
+        raise GitHubError(f"GitHub API returned no {name}: {resp.get('errors')}", errors=resp.get("errors"))
+    return value
+
+
+class RetryPolicy:
+    def __init__(self, attempts=4, backoff=1, max_backoff=60, jitter=0.5, deadline=300):
+        """
+        `attempts` - tries of a request in total
+        `backoff` - delay (seconds) before the first retry, doubled with every next one up to `max_backoff`
+        `jitter` - share of a delay randomly cut off, so concurrent requests don't retry in lockstep
+        `deadline` - seconds a request may take in total, retries included
+        """
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.deadline = deadline
+
+    def delay(self, retry, retry_after=None):
+        """ Delay before the `retry`-th retry (starting from 0), not shorter than `retry_after` """
+        delay = min(self.max_backoff, self.backoff * 2 ** retry) * (1 - self.jitter * random.random())
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+
+class CircuitBreaker:
+    """ Fails requests fast after `threshold` consecutive failures
+
+    While open, one request in `reset_timeout` seconds is let through to probe the endpoint, the circuit is
+    closed once one succeeds.
+    """
+
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+
+    def check(self):
+        if self.opened_at is None:
+            return
+        left = self.opened_at + self.reset_timeout - time.monotonic()
+        if left > 0:
+            GITHUB_CIRCUIT_REJECTIONS.inc()
+            raise CircuitOpenError(f"GitHub API is unavailable after {self.failures} failures in a row",
+                                   retryable=True, retry_after=left)
+        self.opened_at = time.monotonic()  # this request probes, the next one waits for its result
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+
+
+_BREAKERS = {}
+
+
+def circuit_breaker(url):
+    """ Process-wide circuit breaker of the endpoint """
+    breaker = _BREAKERS.get(url)
+    if breaker is None:
+        breaker = _BREAKERS[url] = CircuitBreaker()
+    return breaker
+
+
+def make_session(limit=10, keepalive_timeout=60, ttl_dns_cache=300):
+    """ Create HTTP session with a keep-alive connection pool, it may be shared by several clients
+
+    Must be called from a running event loop and closed with `await session.close()`
+    """
+    connector = aiohttp.TCPConnector(
+        limit=limit,
+        keepalive_timeout=keepalive_timeout,
+        ttl_dns_cache=ttl_dns_cache
+    )
+    return aiohttp.ClientSession(connector=connector)
+
 
 class GitHubClient:
-    def __init__(self, token, logger=None):
+    def __init__(self, token, logger=None, session=None, timeout=30, connect_timeout=10, url=None, retry=None,
+                 breaker=None):
+        """
+        `session` - shared HTTP session (see `make_session`), the client creates and owns its own if None
+        `url` - GraphQL endpoint, GITHUB_API_URL by default
+        `timeout`, `connect_timeout` - timeouts (in seconds) of a single request attempt
+        `retry` - RetryPolicy of failed requests
+        `breaker` - CircuitBreaker, the one shared by all clients of the endpoint by default
+        """
         self.logger = logger or logging.getLogger()
+        self.url = url
+        self.retry = retry or RetryPolicy()
+        self.breaker = breaker
         self.headers = {
             "Authorization": f"bearer {token}"
         }
+        self.timeout = aiohttp.ClientTimeout(total=timeout, connect=connect_timeout)
+        self._session = session
+        self._own_session = session is None
+        self.comment_writer = CommentWriter(self)
+
+    @property
+    def session(self):
+        if self._session is None:
+            self._session = make_session()
+        return self._session
+
+    async def close(self):
+        await self.comment_writer.close()
+        if self._own_session and self._session is not None:
+            await self._session.close()
+        self._session = None
 
-    async def request(self, query, attempts=3):
+    async def request(self, query, attempts=None):
+        """ Make GraphQL request retried according to `self.retry`, raise GitHubError if it has failed
+
+        Responses with data are returned as is, even if they have errors (e.g. some of aliased mutations failed).
+        `attempts` - overrides attempts of the retry policy
+        """
+        with span(f"github {_operation(query)}", cat="github"):
+            return await self._request(query, attempts or self.retry.attempts)
+
+    async def _request(self, query, attempts):
+        url = self.url or GITHUB_API_URL
+        breaker = self.breaker or circuit_breaker(url)
         data = json.dumps(query).encode("utf-8")
+        deadline = time.monotonic() + self.retry.deadline
         self.logger.debug(f"Make GitHub API request: {data} ...")
-        async with aiohttp.ClientSession(headers=self.headers) as session:
-            while True:
-                try:
-                    async with session.post(GITHUB_API_URL, data=data) as response:
-                        result = await response.json()
-                        self.logger.debug(f"GitHub API response: {result}")
-                        return result
-                except:
-                    if attempts == 0:
-                        raise
-                    self.logger.exception(f"Request to GitHb API failed, retry...")
-                    attempts -= 1
-                    await asyncio.sleep(1)
+        for retry in itertools.count():
+            breaker.check()
+            t0 = time.monotonic()
+            timeout = aiohttp.ClientTimeout(total=min(self.timeout.total, deadline - t0), connect=self.timeout.connect)
+            try:
+                with span("github attempt", cat="github"):
+                    async with self.session.post(url, data=data, headers=self.headers, timeout=timeout) as response:
+                        result = await self._result(response)
+            except GitHubError as err:
+                error = err
+            except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                error = GitHubError(f"GitHub API request failed: {err!r}", retryable=True)
+                error.__cause__ = err
+            else:
+                self.logger.debug(f"GitHub API response: {result}")
+                GITHUB_REQUEST_SECONDS.labels("ok").observe(time.monotonic() - t0)
+                breaker.success()
+                return result
+
+            GITHUB_REQUEST_SECONDS.labels("error").observe(time.monotonic() - t0)
+            GITHUB_REQUEST_ERRORS.inc()
+            if isinstance(error, RateLimitError):
+                pass  # GitHub is fine, we are too fast
+            elif error.retryable:
+                breaker.failure()
+            else:
+                breaker.success()  # GitHub is up, it's the request which is wrong
+
+            if not error.retryable or retry + 1 >= attempts:
+                raise error
+            delay = self.retry.delay(retry, error.retry_after)
+            if time.monotonic() + delay >= deadline:
+                raise error
+            self.logger.warning(f"Request to GitHub API failed ({error}), retry in {delay:.1f} seconds...")
+            GITHUB_REQUEST_RETRIES.inc()
+            await asyncio.sleep(delay)
+
+    async def _result(self, response):
+        """ JSON of the response, GitHubError if it's a failure """
+        if response.status in (403, 429) and (
+                "Retry-After" in response.headers or response.headers.get("X-RateLimit-Remaining") == "0"):
+            raise RateLimitError(f"GitHub API rate limit exceeded (HTTP {response.status})", status=response.status,
+                                 retryable=True, retry_after=_retry_after(response.headers))
+        if response.status >= 400:
+            raise GitHubError(f"GitHub API responded with HTTP {response.status}", status=response.status,
+                              retryable=response.status >= 500)
+
+        result = await response.json()
+        errors = result.get("errors")
+        if errors and result.get("data") is None:
+            if any(error.get("type") == "RATE_LIMITED" for error in errors):
+                raise RateLimitError(f"GitHub API rate limit exceeded", errors=errors, retryable=True,
+                                     retry_after=_retry_after(response.headers))
+            # typed errors (NOT_FOUND, FORBIDDEN, ...) won't go away, untyped ones are GitHub's hiccups
+            raise GitHubError(f"GitHub API request failed: {[error.get('message') for error in errors]}",
+                              errors=errors, retryable=all("type" not in error for error in errors))
+        return result
 
     async def add_comment(self, subject_id, content):
-        try:
-            resp = await self.request(add_comment(subject_id=subject_id, content=content))
-            return resp["data"]["addComment"]["commentEdge"]["node"]["id"]
-        except Exception:
-            self.logger.exception(f"Failed to add GitHub comment")
-            return None
+        resp = await self.request(add_comment(subject_id=subject_id, content=content))
+        return _field(resp, "addComment")["commentEdge"]["node"]["id"]
 
     async def update_comment(self, comment_id, content):
-        try:
-            await self.request(update_comment(comment_id=comment_id, content=content))
-        except Exception:
-            self.logger.exception(f"Failed to add GitHub comment")
+        resp = await self.request(update_comment(comment_id=comment_id, content=content))
+        _field(resp, "updateIssueComment")
     
     async def add_or_update_comment(self, subject_id, comment_id, content):
         if comment_id is None:
@@ -53,12 +272,128 @@ class GitHubClient:
             await self.update_comment(comment_id=comment_id, content=content)
             return comment_id
     
-    async def open_pull_requests(self, repo_owner, repo_name):
-        return await self.request(pull_requests(
-            repo_owner=repo_owner,
-            repo_name=repo_name,
-            states=[PullRequestState.OPEN]
-        ))
+    def queue_comment(self, subject_id, comment_id, content):
+        """ Schedule adding (`comment_id` is None) or updating of a comment via background writer
+
+        Return a future resolved with the comment ID once it has been written
+        """
+        return self.comment_writer.add_or_update_comment(subject_id=subject_id, comment_id=comment_id, content=content)
+
+    async def repository(self, repo_owner, repo_name):
+        resp = await self.request(repository(repo_owner=repo_owner, repo_name=repo_name))
+        return _field(resp, "repository")
+
+    async def open_pull_requests(self, repo_owner, repo_name, light=False, after=None):
+        """ Async generator of all open pull requests, page by page
+
+        `light` - fetch only `id`, `baseRefOid` and `headRefOid` fields
+        `after` - cursor to start after, e.g. `endCursor` of a page fetched by `batch_pull_requests`
+        """
+        while True:
+            resp = await self.request(pull_requests(
+                repo_owner=repo_owner,
+                repo_name=repo_name,
+                light=light,
+                states=[PullRequestState.OPEN],
+                after=after
+            ))
+            connection = _field(resp, "repository")["pullRequests"]
+            for pr in connection["nodes"]:
+                yield pr
+            if not connection["pageInfo"]["hasNextPage"]:
+                return
+            after = connection["pageInfo"]["endCursor"]
+
+
+# -------------------------------------------------------------------------------------------------
+class CommentWriter:
+    """ Queue of comment mutations flushed in the background every `interval` seconds
+
+    Repeated updates of the same comment are coalesced, so only the latest body is sent.
+    Up to `batch_size` pending mutations are packed into one aliased GraphQL request.
+    """
+
+    def __init__(self, client, interval=2, batch_size=20):
+        self.client = client
+        self.interval = interval
+        self.batch_size = batch_size
+        self._pending = OrderedDict()  # key -> (mutation, [futures])
+        self._counter = itertools.count()
+        self._task = None
+        self._wakeup = None
+
+    def add_or_update_comment(self, subject_id, comment_id, content):
+        future = asyncio.get_event_loop().create_future()
+        if comment_id is None:
+            key = ("add", next(self._counter))
+            mutation = {"subject_id": subject_id, "content": content}
+        else:
+            key = ("update", comment_id)
+            mutation = {"comment_id": comment_id, "content": content}
+
+        if key in self._pending:
+            _, futures = self._pending[key]
+            futures.append(future)
+            self._pending[key] = (mutation, futures)
+        else:
+            self._pending[key] = (mutation, [future])
+
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+        return future
+
+    async def _run(self):
+        while self._pending:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush(limit=self.batch_size)
+
+    async def flush(self, limit=None):
+        batch = []
+        while self._pending and (limit is None or len(batch) < limit):
+            batch.append(self._pending.popitem(last=False)[1])
+        if not batch:
+            return
+
+        self.client.logger.debug(f"Write {len(batch)} GitHub comments in one request")
+        try:
+            resp = await self.client.request(batch_comments([mutation for mutation, _ in batch]))
+        except Exception as err:
+            self.client.logger.exception(f"Failed to write GitHub comments")
+            for _, futures in batch:
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(err)
+            return
+
+        data = resp.get("data") or {}
+        for i, (mutation, futures) in enumerate(batch):
+            node = data.get(f"m{i}")
+            if node is None:
+                err = GitHubError(f"GitHub comment mutation failed: {resp.get('errors')}", errors=resp.get("errors"))
+                self.client.logger.error(str(err))
+            elif "comment_id" in mutation:
+                comment_id = node["issueComment"]["id"]
+            else:
+                comment_id = node["commentEdge"]["node"]["id"]
+
+            for future in futures:
+                if future.done():
+                    continue
+                if node is None:
+                    future.set_exception(err)
+                else:
+                    future.set_result(comment_id)
+
+    async def close(self):
+        """ Write everything still pending without waiting for the next interval """
+        if self._task is not None:
+            self._wakeup.set()
+            await self._task
+            self._task = None
 
 
 # -------------------------------------------------------------------------------------------------
@@ -69,26 +404,50 @@ class PullRequestState:
     MERGED = "MERGED"
 
 
-def pull_requests(repo_owner, repo_name, **kwargs):
+PULL_REQUEST_FIELDS = """
+    id,
+    number,
+    title,
+    state,
+    createdAt, updatedAt,
+    baseRefName, baseRefOid,
+    headRefName, headRefOid
+"""
+
+PULL_REQUEST_LIGHT_FIELDS = """
+    id,
+    baseRefOid,
+    headRefOid
+"""
+
+
+def repository(repo_owner, repo_name):
+    query = """query($repo_owner:String!, $repo_name:String!) {
+        repository(owner: $repo_owner, name: $repo_name) {
+            id, url, sshUrl
+        }
+    }"""
+
+    return {
+        "query": query,
+        "variables": {
+            "repo_owner": repo_owner,
+            "repo_name": repo_name
+        }
+    }
+
+
+def pull_requests(repo_owner, repo_name, light=False, **kwargs):
+    fields = PULL_REQUEST_LIGHT_FIELDS if light else PULL_REQUEST_FIELDS
 
     query = """query($repo_owner:String!, $repo_name:String!, $states:[PullRequestState!], $after:String) {
         repository(owner: $repo_owner, name: $repo_name) {
-            id, url, sshUrl,
-            pullRequests(last: 100, states: $states, after: $after) {
-                edges {
-                    cursor,
-                    node {
-                        id,
-                        title,
-                        state,
-                        createdAt,
-                        baseRefName, baseRefOid,
-                        headRefName, headRefOid
-                    }
-                }
+            pullRequests(first: 100, states: $states, after: $after) {
+                pageInfo { hasNextPage, endCursor },
+                nodes { %s }
             }
         }
-    }"""
+    }""" % fields
 
     return {
         "query": query,
@@ -100,6 +459,35 @@ def pull_requests(repo_owner, repo_name, **kwargs):
     }
 
 
+def batch_pull_requests(repos, light=False):
+    """ The first page of open PRs of several repositories in one query, aliased as r0, r1, ...
+
+    `repos` - (owner, name) pairs. The query also returns `rateLimit` with its cost and the remaining budget.
+    """
+    fields = PULL_REQUEST_LIGHT_FIELDS if light else PULL_REQUEST_FIELDS
+    params = []
+    aliases = []
+    variables = {}
+    for i, (repo_owner, repo_name) in enumerate(repos):
+        params.append(f"$repo_owner{i}:String!, $repo_name{i}:String!")
+        aliases.append(f"""r{i}: repository(owner: $repo_owner{i}, name: $repo_name{i}) {{
+            pullRequests(first: 100, states: [OPEN]) {{
+                pageInfo {{ hasNextPage, endCursor }},
+                nodes {{ {fields} }}
+            }}
+        }}""")
+        variables[f"repo_owner{i}"] = repo_owner
+        variables[f"repo_name{i}"] = repo_name
+
+    query = "query (%s) {\n        %s\n        rateLimit { limit, cost, remaining, resetAt }\n    }" % (
+        ", ".join(params), "\n        ".join(aliases))
+
+    return {
+        "query": query,
+        "variables": variables
+    }
+
+
 def add_comment(subject_id, content):
     query = """mutation ($subject_id:ID!, $content:String!) {
         addComment(input: {
@@ -138,6 +526,34 @@ def update_comment(comment_id, content):
     }
 
 
+def batch_comments(mutations):
+    """ Pack several add/update comment mutations into one request, results are aliased as m0, m1, ... """
+    params = []
+    fields = []
+    variables = {}
+    for i, mutation in enumerate(mutations):
+        variables[f"content{i}"] = mutation["content"]
+        if "comment_id" in mutation:
+            params.append(f"$comment_id{i}:ID!, $content{i}:String!")
+            fields.append(f"""m{i}: updateIssueComment(input: {{ id: $comment_id{i}, body: $content{i} }}) {{
+            issueComment {{ id }}
+        }}""")
+            variables[f"comment_id{i}"] = mutation["comment_id"]
+        else:
+            params.append(f"$subject_id{i}:ID!, $content{i}:String!")
+            fields.append(f"""m{i}: addComment(input: {{ subjectId: $subject_id{i}, body: $content{i} }}) {{
+            commentEdge {{ cursor, node {{ id }} }}
+        }}""")
+            variables[f"subject_id{i}"] = mutation["subject_id"]
+
+    query = "mutation (%s) {\n        %s\n    }" % (", ".join(params), "\n        ".join(fields))
+
+    return {
+        "query": query,
+        "variables": variables
+    }
+
+
 # -------------------------------------------------------------------------------------------------
 if __name__ == "__main__":
     import argparse
@@ -156,5 +572,11 @@ if __name__ == "__main__":
 
     xid = "MDExOlB1bGxSZXF1ZXN0NDMxNTczOTQz"
 
-    response = asyncio.run(client.request(add_comment(subject_id=xid, content="a-a-a-a-a!")))
+    async def run():
+        try:
+            return await client.request(add_comment(subject_id=xid, content="a-a-a-a-a!"))
+        finally:
+            await client.close()
+
+    response = asyncio.run(run())
     print(json.dumps(response, indent=2))
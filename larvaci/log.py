@@ -1,27 +1,163 @@
 import logging
 import logging.handlers
 import os
+import json
+import queue
+import atexit
+import threading
+import contextvars
 
 
-def init_logger(name=None, logdir=None, verbose=False):
+# ID of PR being processed by the current task, JSON logs carry it as "pr" field
+current_pr = contextvars.ContextVar("larvaci_current_pr", default=None)
+
+_QUEUE_HANDLERS = []
+_STOP = object()
+
+
+class _ContextFilter(logging.Filter):
+    def filter(self, record):
+        if not hasattr(record, "pr"):
+            record.pr = current_pr.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """ One JSON object per line with flow (logger name), PR and PID fields """
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "flow": record.name,
+            "pr": getattr(record, "pr", None),
+            "pid": getattr(record, "pid", None),
+            "message": record.getMessage()
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class _BatchFlushMixin:
+    """ flush() does nothing, the writer thread calls flush_batch() once per batch of records """
+
+    def flush(self):
+        pass
+
+    def flush_batch(self):
+        super().flush()
+
+
+class _BatchRotatingFileHandler(_BatchFlushMixin, logging.handlers.RotatingFileHandler):
+    pass
+
+
+class _BatchStreamHandler(_BatchFlushMixin, logging.StreamHandler):
+    pass
+
+
+class QueueLogHandler(logging.handlers.QueueHandler):
+    """ Only enqueues records, `handler` writes them in a background thread
+
+    Records are dropped (and counted in `dropped`) when the queue is full, so logging never blocks.
+    """
+
+    def __init__(self, handler, maxsize=10000, batch_size=512):
+        super().__init__(queue.Queue(maxsize))
+        self.handler = handler
+        self.batch_size = batch_size
+        self.dropped = 0
+        self._reported = 0
+        self._thread = threading.Thread(target=self._write, name="larvaci-log-writer", daemon=True)
+        self._thread.start()
+        _QUEUE_HANDLERS.append(self)
+
+    def prepare(self, record):
+        # the message must be built now, arguments may change later; formatting is done by the writer
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _write(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            for record in batch:
+                if record is _STOP:
+                    self.handler.flush_batch()
+                    return
+                self.handler.handle(record)
+
+            if self.dropped != self._reported:
+                lost = self.dropped - self._reported
+                self._reported = self.dropped
+                self.handler.handle(logging.makeLogRecord({
+                    "name": "larvaci.log", "levelno": logging.WARNING, "levelname": "WARNING",
+                    "msg": f"{lost} log messages were lost, logging queue is full ({self.dropped} in total)"
+                }))
+            self.handler.flush_batch()
+
+    def stop(self):
+        self.queue.put(_STOP)
+        self._thread.join()
+        self.handler.close()
+
+
+def dropped_messages():
+    """ Number of log messages lost because of full logging queues """
+    return sum(handler.dropped for handler in _QUEUE_HANDLERS)
+
+
+@atexit.register
+def shutdown_logging():
+    """ Write everything still queued and stop writer threads """
+    while _QUEUE_HANDLERS:
+        _QUEUE_HANDLERS.pop().stop()
+
+
+def init_logger(name=None, logdir=None, verbose=False, queued=False, json_format=False, queue_size=10000):
+    """
+    `queued` - log calls only enqueue records, a background thread writes them in batches
+    `json_format` - write JSON lines with flow/PR/PID fields instead of plain text
+    """
     logger = logging.getLogger(name)
+    file_handler_cls = _BatchRotatingFileHandler if queued else logging.handlers.RotatingFileHandler
+    stream_handler_cls = _BatchStreamHandler if queued else logging.StreamHandler
     if logdir is not None:
         os.makedirs(logdir, exist_ok=True)
         fname = "larvaci.log" if (name is None) else f"larvaci-{name}.log"
-        handler = logging.handlers.RotatingFileHandler(
+        handler = file_handler_cls(
             filename=os.path.join(logdir, fname),
             mode="a",
             maxBytes=2 << 20,  # 1Mb
             backupCount=5
         )
     else:
-        handler = logging.StreamHandler()
-    handler.setFormatter(logging.Formatter(fmt="%(asctime)s [%(levelname)s] %(message)s"))
+        handler = stream_handler_cls()
+    if json_format:
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(fmt="%(asctime)s [%(levelname)s] %(message)s"))
+    if queued:
+        handler = QueueLogHandler(handler, maxsize=queue_size)
+    handler.addFilter(_ContextFilter())
     logger.addHandler(handler)
     logger.setLevel(logging.DEBUG if verbose else logging.INFO)
     logger.propagate = False
     return logger
 
 
-def init_logging(verbose=False, logdir=None):
-    init_logger(name=None, verbose=verbose, logdir=logdir)
+def init_logging(verbose=False, logdir=None, **kwargs):
+    init_logger(name=None, verbose=verbose, logdir=logdir, **kwargs)
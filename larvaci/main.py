@@ -3,7 +3,14 @@ import logging
 import asyncio
 import functools
 import time
-from .log import init_logger
+from .log import init_logger, dropped_messages
+from .github import GitHubClient, make_session
+from .webhook import WebhookReceiver
+from .scheduler import Scheduler
+from .supervisor import supervise, child_command
+from .dispatch import Coordinator, Worker
+from .metrics import MetricsServer
+from .poller import SharedPoller
 
 
 __FLOWS = {}
@@ -12,6 +19,8 @@ __LOG_DIR = os.path.join(os.getcwd(), "larvaci-logs")
 __WORK_DIR = os.path.join(os.getcwd(), "larvaci-workdir")
 __STOP_SIGNALS = ("SIGINT", "SIGTERM")  # these signals will stop service
 __GITHUB_TOKEN_VAR = "GITHUB_ACCESS_TOKEN"
+__WEBHOOK_SECRET_VAR = "GITHUB_WEBHOOK_SECRET"
+__DISPATCH_TOKEN_VAR = "LARVACI_DISPATCH_TOKEN"
 
 
 def register_flow(flow_cls):
@@ -19,35 +28,113 @@ def register_flow(flow_cls):
     return flow_cls
 
 
-async def main_loop(workdir_base, github_token):
+async def main_loop(workdir_base, github_token, github_connections=10, github_url=None, webhook_port=None, webhook_host="0.0.0.0",
+                    webhook_secret=None, max_cpus=None, max_memory=None, flow_names=None, coordinator=None,
+                    worker=None, worker_jobs=1, log_queue=False, log_json=False, metrics_port=None,
+                    metrics_host="0.0.0.0", shared_poll=None, dispatch_token=None):
+    """
+    `github_url` - GitHub GraphQL API endpoint, e.g. a local stand-in (see benchmarks/fakegithub.py)
+    `coordinator` - address to listen to remote workers on, flows only poll and dispatch PRs to them
+    `worker` - address of a coordinator, flows don't poll but run `worker_jobs` jobs received from it
+    `dispatch_token` - secret shared by a coordinator and its workers, required on TCP addresses
+    `log_queue`, `log_json` - write logs of flows in a background thread, as JSON lines
+    `metrics_port` - serve metrics in Prometheus format on http://<metrics_host>:<metrics_port>/metrics
+    `shared_poll` - poll open PRs of all flows with one poller every `shared_poll` seconds (at least)
+    """
     import signal
 
     logging.info("Start main loop...")
 
+    # all flows share one pool of keep-alive connections to GitHub API
+    github_session = make_session(limit=github_connections)
+
+    scheduler = None
+    if max_cpus is not None or max_memory is not None:
+        scheduler = Scheduler(cpus=max_cpus or os.cpu_count(), memory=max_memory)
+        logging.info(f"Jobs of all flows share {scheduler.cpus} CPUs and {max_memory or 'unlimited'} MiB of memory")
+
+    dispatcher = None
+    if coordinator is not None:
+        dispatcher = Coordinator(token=dispatch_token)
+        await dispatcher.start(coordinator)
+
+    poller = None
+    if shared_poll is not None and worker is None:
+        poller = SharedPoller(GitHubClient(token=github_token, session=github_session, url=github_url),
+                              interval=shared_poll)
+
     flows = []
     tasks = []
     for name, flow_cls in __FLOWS.items():
+        if flow_names and name not in flow_names:
+            continue
         workdir = os.path.join(workdir_base, name)
         logdir = os.path.join(workdir, "logs")
 
         os.makedirs(workdir, exist_ok=True)
-        logger = init_logger(name=name, logdir=logdir, verbose=True)
+        logger = init_logger(name=name, logdir=logdir, verbose=True, queued=log_queue, json_format=log_json)
 
         logging.info(f"Run flow {name} in {workdir}")
-        flow = flow_cls(workdir=workdir, logger=logger, github_token=github_token)
-        tasks.append(asyncio.create_task(flow._run()))
+        flow = flow_cls(workdir=workdir, logger=logger, github_token=github_token, github_session=github_session,
+                        github_url=github_url)
+        flow.scheduler = scheduler
+        flow.dispatcher = dispatcher
+        if poller is not None and getattr(flow, "REPO_NAME", None) is not None:
+            poller.register(flow)
         flows.append(flow)
+        if worker is None:
+            tasks.append(asyncio.create_task(flow._run()))
+
+    if poller is not None:
+        tasks.append(asyncio.create_task(poller.run()))
+
+    if worker is not None:
+        workers = {flow.name: flow for flow in flows if hasattr(flow, "run_job")}
+        for index in range(worker_jobs):
+            tasks.append(asyncio.create_task(Worker(workers, worker, token=dispatch_token, index=index).run()))
+        for flow in flows:  # flow._run() isn't called, it would have started them
+            tasks += [asyncio.create_task(coro) for coro in flow.background_tasks()]
 
     def stop():
         logging.info("Stopping, cancel all tasks...")
         for task in tasks:
             task.cancel()
 
+    webhooks = None
+    if webhook_port is not None:
+        webhooks = WebhookReceiver(flows, secret=webhook_secret)
+        await webhooks.start(webhook_host, webhook_port)
+
+    metrics = None
+    if metrics_port is not None:
+        metrics = MetricsServer()
+        await metrics.start(metrics_host, metrics_port)
+
     eloop = asyncio.get_event_loop()
     for signame in __STOP_SIGNALS:
         eloop.add_signal_handler(getattr(signal, signame), stop)
-
-    done, pending = await asyncio.wait(tasks)
+    eloop.add_signal_handler(signal.SIGUSR1, lambda: [flow.wakeup() for flow in flows])
+
+    try:
+        done, pending = await asyncio.wait(tasks)
+    finally:
+        if worker is not None:
+            for flow in flows:
+                flow.shutdown()
+                await flow.github.close()
+        if dispatcher is not None:
+            await dispatcher.stop()
+        if webhooks is not None:
+            await webhooks.stop()
+        if metrics is not None:
+            await metrics.stop()
+        if poller is not None:
+            await poller.github.close()
+        await github_session.close()
+    if scheduler is not None:
+        logging.info(f"Scheduler statistics: {scheduler.stats()}")
+    if log_queue:
+        logging.info(f"{dropped_messages()} log messages were lost")
     logging.info("All tasks has been finished")
 
 def main():
@@ -62,20 +149,49 @@ def main():
     parser.add_argument("--log-dir",        help="Directory to write logs into", default=None, type=str)
     parser.add_argument("--work-dir",       help="Base working directory", default=__WORK_DIR, type=str)
     parser.add_argument("--github-token",   help="GitHub acces token", type=str)
+    parser.add_argument("--github-connections", help="Max number of connections to GitHub API", default=10, type=int)
+    parser.add_argument("--github-url",     help="GitHub GraphQL API endpoint", default=None, type=str)
+    parser.add_argument("--webhook-port",   help="Listen to GitHub webhooks on this port", default=None, type=int)
+    parser.add_argument("--webhook-host",   help="Address to listen to GitHub webhooks on", default="0.0.0.0", type=str)
+    parser.add_argument("--max-cpus",       help="CPU slots shared by jobs of all flows, divided equally between "
+                                             "flow processes of --processes", default=None, type=int)
+    parser.add_argument("--max-memory",     help="Memory (MiB) shared by jobs of all flows, divided equally between "
+                                             "flow processes of --processes", default=None, type=int)
+    parser.add_argument("--metrics-port",   help="Serve metrics on this port, flow processes of --processes use "
+                                             "consecutive ports starting from it", default=None, type=int)
+    parser.add_argument("--metrics-host",   help="Address to serve metrics on", default="0.0.0.0", type=str)
+    parser.add_argument("--shared-poll",    help="Poll open PRs of all flows at once every SECONDS",
+                        default=None, type=float)
+    parser.add_argument("--log-queue",      help="Write logs in a background thread", action="store_true", default=False)
+    parser.add_argument("--log-json",       help="Write logs as JSON lines", action="store_true", default=False)
+    parser.add_argument("--flow",           help="Run only this flow (may be repeated)", action="append", default=None)
+    parser.add_argument("--coordinator",    help="Listen to workers on ADDRESS (host:port or unix:path) and "
+                                             f"dispatch PRs to them, TCP needs a token in {__DISPATCH_TOKEN_VAR}",
+                        default=None, type=str)
+    parser.add_argument("--worker",         help="Process PRs dispatched by coordinator at ADDRESS", default=None,
+                        type=str)
+    parser.add_argument("--worker-jobs",    help="Number of PRs processed by a worker at once", default=1, type=int)
+    parser.add_argument("--processes",      help="Run every flow in its own supervised process", action="store_true",
+                        default=False)
 
     args = parser.parse_args()
+    if args.processes and (args.coordinator is not None or args.worker is not None):
+        parser.error("--coordinator and --worker can not be combined with --processes")
+    if args.processes and args.shared_poll is not None:
+        parser.error("--shared-poll polls the flows of one process, it can not be combined with --processes")
 
     if args.list:
         print("\n".join(name for name in __FLOWS.keys()))
         exit(0)
 
-    log_dir = None
+    log_dir = args.log_dir
 
     if args.detach:
         if args.pid_file is None:
             args.pid_file = __PID_FILE
 
-        log_dir = os.path.join(args.work_dir, "logs")
+        if log_dir is None:
+            log_dir = args.log_dir = os.path.join(args.work_dir, "logs")
         os.makedirs(log_dir, exist_ok=True)
 
         pid = os.fork()
@@ -93,12 +209,47 @@ def main():
         with open(args.pid_file, "w") as f:
             f.write(str(os.getpid()))
 
-    init_logger(verbose=args.verbose, logdir=log_dir)
+    if args.flow and log_dir is not None:
+        log_dir = os.path.join(log_dir, "-".join(args.flow))  # don't share log files with other processes
+
+    init_logger(verbose=args.verbose, logdir=log_dir, queued=args.log_queue, json_format=args.log_json)
     if args.github_token is None:
         args.github_token = os.environ[__GITHUB_TOKEN_VAR]
 
+    if args.processes and not args.flow:
+        asyncio.run(supervise(
+            flows=__FLOWS,
+            child_args=child_command(args, processes=len(__FLOWS)),
+            workdir_base=args.work_dir,
+            github_token=args.github_token,
+            detached=args.detach,
+            webhook_port=args.webhook_port,
+            webhook_host=args.webhook_host,
+            webhook_secret=os.environ.get(__WEBHOOK_SECRET_VAR),
+            metrics_port=args.metrics_port,
+            metrics_host=args.metrics_host
+        ))
+        return
+
     asyncio.run(main_loop(
         workdir_base=args.work_dir,
-        github_token=args.github_token
+        github_token=args.github_token,
+        github_connections=args.github_connections,
+        github_url=args.github_url,
+        webhook_port=args.webhook_port,
+        webhook_host=args.webhook_host,
+        webhook_secret=os.environ.get(__WEBHOOK_SECRET_VAR),
+        max_cpus=args.max_cpus,
+        max_memory=args.max_memory,
+        flow_names=args.flow,
+        coordinator=args.coordinator,
+        worker=args.worker,
+        worker_jobs=args.worker_jobs,
+        log_queue=args.log_queue,
+        log_json=args.log_json,
+        metrics_port=args.metrics_port,
+        metrics_host=args.metrics_host,
+        shared_poll=args.shared_poll,
+        dispatch_token=os.environ.get(__DISPATCH_TOKEN_VAR)
     ))
 
@@ -0,0 +1,181 @@
+""" Counters, gauges and histograms exposed in Prometheus text format via HTTP /metrics
+
+Metrics are registered in the process-wide REGISTRY when they are created, so modules declare them at
+import time and update them unconditionally: an update costs a dict lookup and an addition.
+"""
+import bisect
+import logging
+from aiohttp import web
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f"{k}=\"{v}\"" for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise RuntimeError(f"metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+
+    def expose(self):
+        """ All metrics in Prometheus text exposition format """
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.TYPE}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class _Metric:
+    TYPE = None
+
+    def __init__(self, name, help, labels=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._children = {}
+        if not self.label_names:
+            self.labels()  # exposed as zero right away
+        if registry is not None:
+            registry.register(self)
+
+    def labels(self, *values):
+        """ Child metric for the given label values """
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.label_names):
+                raise RuntimeError(f"metric {self.name} has labels {self.label_names}, got {values}")
+            child = self._children[values] = self._new_child()
+        return child
+
+    def samples(self):
+        for values, child in sorted(self._children.items(), key=lambda item: tuple(map(str, item[0]))):
+            yield from child.samples(self.name, self.label_names, values)
+
+
+class _Value:
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name, label_names, values):
+        yield f"{name}{_format_labels(label_names, values)} {_format_value(self.value)}"
+
+
+class _GaugeValue(_Value):
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Counter(_Metric):
+    TYPE = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class Gauge(_Metric):
+    TYPE = "gauge"
+
+    def _new_child(self):
+        return _GaugeValue()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+    def set(self, value):
+        self.labels().set(value)
+
+
+class _HistogramValue:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is for values above all buckets
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, label_names, values):
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"), ), self.counts):
+            cumulative += count
+            le = (("le", _format_value(bound)), )
+            yield f"{name}_bucket{_format_labels(label_names, values, le)} {cumulative}"
+        labels = _format_labels(label_names, values)
+        yield f"{name}_sum{labels} {_format_value(self.sum)}"
+        yield f"{name}_count{labels} {self.count}"
+
+
+class Histogram(_Metric):
+    TYPE = "histogram"
+    # seconds, from a git call to a full build
+    DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 600, 1800, 3600)
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help, labels=labels, registry=registry)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+
+# -------------------------------------------------------------------------------------------------
+class MetricsServer:
+    """ HTTP endpoint serving GET /metrics """
+
+    def __init__(self, registry=REGISTRY, logger=None):
+        self.registry = registry
+        self.logger = logger or logging.getLogger()
+        self._runner = None
+
+    async def handle(self, request):
+        return web.Response(text=self.registry.expose(), content_type="text/plain", charset="utf-8")
+
+    async def start(self, host, port):
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        self.logger.info(f"Serve metrics on http://{host}:{port}/metrics")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
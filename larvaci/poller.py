@@ -0,0 +1,126 @@
+""" Process-wide poller of open PRs of all registered flows
+
+Instead of every flow querying GitHub on its own timer, the poller fetches open PRs of all flows'
+repositories with aliased GraphQL queries (`chunk_size` repositories per query), keeps the latest snapshot
+of every repository and wakes up flows whose PRs have changed. Flows woken up by anything else (webhooks,
+SIGUSR1) know more than the snapshot and query GitHub themselves in that iteration. The interval between
+polls is stretched when the rate limit budget runs low, so the rest of the budget lasts until it is reset.
+"""
+import time
+import asyncio
+import logging
+from datetime import datetime, timezone
+from .github import GitHubError, batch_pull_requests
+from .metrics import Gauge
+
+
+RATE_LIMIT_REMAINING = Gauge("larvaci_github_rate_limit_remaining", "Remaining GitHub API rate limit points")
+POLL_INTERVAL = Gauge("larvaci_poller_interval_seconds", "Current interval between polls of the shared poller")
+
+
+def _timestamp(iso):
+    return datetime.strptime(iso, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc).timestamp()
+
+
+def _revisions(prs):
+    return {pr["id"]: (pr["baseRefOid"], pr["headRefOid"]) for pr in prs}
+
+
+class SharedPoller:
+    def __init__(self, github, interval=60, chunk_size=25, reserve=0.2, logger=None):
+        """
+        `github` - GitHubClient to make queries with
+        `chunk_size` - repositories per query, keeps the query within GitHub node and cost limits
+        `reserve` - share of the rate limit left to everything else (comments, repository info, flows' own polls)
+        """
+        self.github = github
+        self.interval = interval
+        self.chunk_size = chunk_size
+        self.reserve = reserve
+        self.logger = logger or logging.getLogger()
+        self.rate_limit = None  # the latest `rateLimit`: limit, cost, remaining, resetAt
+        self.current_interval = interval
+        self._retry_after = None  # seconds GitHub has asked to wait after a failed poll
+        self._flows = {}  # (owner, name) -> [flows]
+        self._snapshots = {}  # (owner, name) -> [open PRs]
+
+    def register(self, flow):
+        """ Poll PRs of the flow's repository, the flow takes them via `pull_requests()` """
+        self._flows.setdefault((flow.REPO_OWNER, flow.REPO_NAME), []).append(flow)
+        flow.poller = self
+
+    def pull_requests(self, repo_owner, repo_name):
+        """ Open PRs of the repository as of the latest poll, None if it hasn't been polled successfully yet """
+        return self._snapshots.get((repo_owner, repo_name))
+
+    async def poll(self):
+        """ Poll all repositories, return the rate limit cost of it """
+        repos = list(self._flows)
+        chunks = [repos[i:i + self.chunk_size] for i in range(0, len(repos), self.chunk_size)]
+        results = await asyncio.gather(*(self._poll_chunk(chunk) for chunk in chunks), return_exceptions=True)
+        cost = 0
+        self._retry_after = None
+        for chunk, result in zip(chunks, results):
+            if isinstance(result, Exception):
+                self.logger.error(f"Failed to poll PRs of {len(chunk)} repositories: {result!r}")
+                if isinstance(result, GitHubError) and result.retry_after is not None:
+                    self._retry_after = max(self._retry_after or 0, result.retry_after)
+            else:
+                cost += result
+        return cost
+
+    async def _poll_chunk(self, repos):
+        resp = await self.github.request(batch_pull_requests(repos))
+        data = resp.get("data") or {}
+        rate_limit = data.get("rateLimit")
+        if rate_limit is not None:
+            self.rate_limit = rate_limit
+            RATE_LIMIT_REMAINING.set(rate_limit["remaining"])
+
+        for i, (repo_owner, repo_name) in enumerate(repos):
+            repository = data.get(f"r{i}")
+            if repository is None:
+                self.logger.error(f"Failed to poll PRs of {repo_owner}/{repo_name}: {resp.get('errors')}")
+                continue
+            connection = repository["pullRequests"]
+            prs = connection["nodes"]
+            if connection["pageInfo"]["hasNextPage"]:
+                # rare enough to fetch the rest page by page
+                prs += [pr async for pr in self.github.open_pull_requests(
+                    repo_owner=repo_owner, repo_name=repo_name, after=connection["pageInfo"]["endCursor"])]
+            self._update((repo_owner, repo_name), prs)
+        return rate_limit["cost"] if rate_limit is not None else 0
+
+    def _update(self, repo, prs):
+        old = self._snapshots.get(repo)
+        self._snapshots[repo] = prs
+        if old is None or _revisions(old) != _revisions(prs):
+            for flow in self._flows[repo]:
+                flow.wakeup(fresh=True)
+
+    def next_interval(self, cost):
+        """ Interval spending the budget left above the reserve evenly until the rate limit is reset """
+        if self._retry_after is not None:
+            return max(self.interval, self._retry_after)
+        if self.rate_limit is None or cost <= 0:
+            return self.interval
+        reset_in = max(0.0, _timestamp(self.rate_limit["resetAt"]) - time.time())
+        budget = self.rate_limit["remaining"] - self.reserve * self.rate_limit["limit"]
+        if budget < cost:
+            return max(self.interval, reset_in)
+        return max(self.interval, reset_in * cost / budget)
+
+    async def run(self):
+        self.logger.info(f"Poll PRs of {len(self._flows)} repositories every {self.interval} seconds")
+        while True:
+            t0 = time.monotonic()
+            cost = await self.poll()
+            interval = self.next_interval(cost)
+            if self._retry_after is not None:
+                self.logger.warning(f"GitHub API has asked to wait, poll again in {interval:.0f} seconds")
+            elif interval > self.interval:
+                self.logger.warning(f"GitHub API budget runs low ({self.rate_limit['remaining']} points left), "
+                                    f"poll every {interval:.0f} seconds")
+            self.current_interval = interval
+            POLL_INTERVAL.set(interval)
+            await asyncio.sleep(max(0.0, interval - (time.monotonic() - t0)))
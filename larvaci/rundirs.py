@@ -0,0 +1,148 @@
+import os
+import json
+import time
+import shutil
+import asyncio
+import logging
+from collections import defaultdict
+
+
+MARKER_FNAME = ".larvaci.json"  # written into every run dir, tells which PR revision it belongs to
+TRASH_PREFIX = ".trash-"  # run dirs moved aside to be deleted by the collector
+
+
+class RunDir:
+    def __init__(self, path, pr_id, created, size):
+        self.path = path
+        self.pr_id = pr_id
+        self.created = created
+        self.size = size
+
+
+def write_marker(rundir, pr):
+    with open(os.path.join(rundir, MARKER_FNAME), "w") as f:
+        json.dump({
+            "id": pr["id"],
+            "number": pr.get("number"),
+            "baseRefOid": pr["baseRefOid"],
+            "headRefOid": pr["headRefOid"],
+            "created": time.time()
+        }, f)
+
+
+def trash(path):
+    """ Move dir aside (instant) instead of deleting it, the collector deletes it later """
+    trash_path = os.path.join(os.path.dirname(path), f"{TRASH_PREFIX}{os.path.basename(path)}-{time.time_ns()}")
+    os.rename(path, trash_path)
+
+
+def dir_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass  # removed meanwhile
+    return size
+
+
+def scan(runs_dir):
+    """ List run dirs and trashed dirs in `runs_dir` (blocking, it reads the whole tree) """
+    rundirs, trashed = [], []
+    try:
+        names = os.listdir(runs_dir)
+    except FileNotFoundError:
+        return rundirs, trashed
+
+    for name in names:
+        path = os.path.join(runs_dir, name)
+        if not os.path.isdir(path) or os.path.islink(path):
+            continue
+        if name.startswith(TRASH_PREFIX):
+            trashed.append(RunDir(path, None, 0, dir_size(path)))
+            continue
+
+        pr_id, created = None, os.path.getmtime(path)
+        try:
+            with open(os.path.join(path, MARKER_FNAME), "r") as f:
+                marker = json.load(f)
+            pr_id, created = marker["id"], marker["created"]
+        except (OSError, ValueError, KeyError):
+            pass  # made by an older version, only age and quota limits apply
+        rundirs.append(RunDir(path, pr_id, created, dir_size(path)))
+    return rundirs, trashed
+
+
+class RunDirCollector:
+    """ Deletes old run dirs according to the retention policy, deletions run in a thread pool
+
+    `keep_per_pr` - number of the most recent run dirs kept for every PR
+    `max_age` - run dirs older than this (seconds) are deleted
+    `max_size` - total size (MiB) of run dirs, the oldest ones are deleted to fit in
+    None disables the corresponding limit.
+    """
+
+    def __init__(self, runs_dir, keep_per_pr=None, max_age=None, max_size=None, logger=None):
+        self.runs_dir = runs_dir
+        self.keep_per_pr = keep_per_pr
+        self.max_age = max_age
+        self.max_size = max_size
+        self.logger = logger or logging.getLogger()
+
+        self.deleted_total = 0
+        self.reclaimed_total = 0
+        self.time_total = 0.0
+
+    def select(self, rundirs, busy=(), now=None):
+        """ Return run dirs to delete, `busy` are paths of run dirs in use which are never deleted """
+        now = time.time() if now is None else now
+        candidates = sorted((r for r in rundirs if r.path not in busy), key=lambda r: r.created)
+        doomed = set()
+
+        if self.max_age is not None:
+            doomed.update(r.path for r in candidates if now - r.created > self.max_age)
+
+        if self.keep_per_pr is not None:
+            by_pr = defaultdict(list)
+            for r in candidates:
+                if r.pr_id is not None:
+                    by_pr[r.pr_id].append(r)
+            for runs in by_pr.values():
+                doomed.update(r.path for r in runs[:max(0, len(runs) - self.keep_per_pr)])
+
+        if self.max_size is not None:
+            total = sum(r.size for r in rundirs if r.path not in doomed)
+            for r in candidates:
+                if total <= self.max_size << 20:
+                    break
+                if r.path not in doomed:
+                    doomed.add(r.path)
+                    total -= r.size
+
+        return [r for r in candidates if r.path in doomed]
+
+    async def collect(self, busy=()):
+        """ Apply the retention policy once, return (number of deleted dirs, reclaimed bytes, seconds spent) """
+        eloop = asyncio.get_event_loop()
+        t0 = time.monotonic()
+        rundirs, trashed = await eloop.run_in_executor(None, scan, self.runs_dir)
+
+        deleted, reclaimed = 0, 0
+        for r in trashed + self.select(rundirs, busy=set(busy)):
+            try:
+                await eloop.run_in_executor(None, shutil.rmtree, r.path)
+            except OSError as err:
+                self.logger.warning(f"Failed to delete run dir {r.path}: {err}")
+                continue
+            deleted += 1
+            reclaimed += r.size
+        dur = time.monotonic() - t0
+
+        self.deleted_total += deleted
+        self.reclaimed_total += reclaimed
+        self.time_total += dur
+        if deleted:
+            self.logger.info(f"Deleted {deleted} run dirs, {reclaimed >> 20} MiB reclaimed in {dur:.3f} seconds "
+                             f"({self.deleted_total} dirs, {self.reclaimed_total >> 20} MiB in total)")
+        return deleted, reclaimed, dur
@@ -0,0 +1,53 @@
+""" Wrapper reporting resource usage of a command and all its descendants
+
+Usage: python rusage.py <fd> <command> [args...]
+
+Runs the command, forwards termination signals to it, writes its rusage as JSON into file descriptor
+<fd> and exits with the same status. SIGKILL can't be forwarded, so larvaci starts the wrapper in its own
+process group and kills the whole group. The script must not import larvaci to start fast.
+"""
+import os
+import sys
+import json
+import signal
+
+
+_FORWARDED_SIGNALS = (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGQUIT)
+
+
+def main(argv):
+    fd = int(argv[1])
+    args = argv[2:]
+    os.set_inheritable(fd, False)
+
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.execvp(args[0], args)
+        except OSError as err:
+            sys.stderr.write(f"cannot execute {args[0]}: {err}\n")
+        os._exit(127)
+
+    for sig in _FORWARDED_SIGNALS:
+        signal.signal(sig, lambda signum, frame: os.kill(pid, signum))
+
+    _, status, ru = os.wait4(pid, 0)
+    usage = {
+        "user_time": ru.ru_utime,
+        "system_time": ru.ru_stime,
+        "max_rss": ru.ru_maxrss,  # KiB
+        "read_blocks": ru.ru_inblock,
+        "write_blocks": ru.ru_oublock
+    }
+    with os.fdopen(fd, "w") as f:
+        json.dump(usage, f)
+
+    if os.WIFSIGNALED(status):
+        sig = os.WTERMSIG(status)
+        signal.signal(sig, signal.SIG_DFL)
+        os.kill(os.getpid(), sig)
+    return os.WEXITSTATUS(status)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
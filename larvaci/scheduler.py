@@ -0,0 +1,132 @@
+import heapq
+import asyncio
+import logging
+import itertools
+import time
+import contextlib
+
+
+class Scheduler:
+    """ Process-wide pool of CPU and memory slots shared by all flows
+
+    Jobs wait in a priority queue (lower `priority` goes first, FIFO within the same priority) until
+    enough CPUs and memory are free. The queue is strict: a big job at its head is not overtaken by
+    smaller ones, so it can't starve.
+    """
+
+    def __init__(self, cpus, memory=None, logger=None):
+        """
+        `cpus` - number of CPU slots
+        `memory` - memory budget in MiB, None means unlimited
+        """
+        self.cpus = cpus
+        self.memory = memory
+        self.logger = logger or logging.getLogger()
+        self._used_cpus = 0
+        self._used_memory = 0
+        self._queue = []
+        self._counter = itertools.count()
+
+        self.jobs = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+
+    def _clamp(self, cpus, memory):
+        # a job bigger than the whole host can still run, alone
+        cpus = min(cpus, self.cpus)
+        if self.memory is not None:
+            memory = min(memory, self.memory)
+        return cpus, memory
+
+    def _fits(self, cpus, memory):
+        if self._used_cpus + cpus > self.cpus:
+            return False
+        return self.memory is None or self._used_memory + memory <= self.memory
+
+    @staticmethod
+    def _priority_key(priority):
+        # numbers and tuples (e.g. PR flows' job_priority) are compared as tuples, a number n as (n, )
+        return priority if isinstance(priority, tuple) else (priority, )
+
+    def _take(self, cpus, memory):
+        self._used_cpus += cpus
+        self._used_memory += memory
+
+    def _dispatch(self):
+        while self._queue:
+            _, _, cpus, memory, future = self._queue[0]
+            if future.done():  # cancelled while waiting
+                heapq.heappop(self._queue)
+                continue
+            if not self._fits(cpus, memory):
+                break
+            heapq.heappop(self._queue)
+            self._take(cpus, memory)
+            future.set_result(None)
+
+    async def acquire(self, cpus=1, memory=0, priority=0):
+        cpus, memory = self._clamp(cpus, memory)
+        if not self._queue and self._fits(cpus, memory):
+            self._take(cpus, memory)
+            return
+
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(self._queue, (self._priority_key(priority), next(self._counter), cpus, memory, future))
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release(cpus, memory)  # the slot was granted just before cancellation
+            else:
+                self._dispatch()
+            raise
+
+    def release(self, cpus=1, memory=0):
+        cpus, memory = self._clamp(cpus, memory)
+        self._used_cpus -= cpus
+        self._used_memory -= memory
+        self._dispatch()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, cpus=1, memory=0, priority=0, name=None):
+        """ Async context manager holding `cpus` slots and `memory` MiB while the job runs """
+        t0 = time.monotonic()
+        await self.acquire(cpus=cpus, memory=memory, priority=priority)
+        waited = time.monotonic() - t0
+
+        self.jobs += 1
+        self.wait_time_total += waited
+        self.wait_time_max = max(self.wait_time_max, waited)
+        self.logger.info(f"Job {name} got slot (cpus={cpus}, memory={memory}MiB) in {waited:.3f} seconds, "
+                         f"{self.queue_size} jobs are waiting")
+        try:
+            yield waited
+        finally:
+            self.release(cpus=cpus, memory=memory)
+
+    @property
+    def queue_size(self):
+        return sum(1 for item in self._queue if not item[-1].done())
+
+    def stats(self):
+        return {
+            "jobs": self.jobs,
+            "queue_size": self.queue_size,
+            "used_cpus": self._used_cpus,
+            "used_memory": self._used_memory,
+            "wait_time_total": self.wait_time_total,
+            "wait_time_avg": self.wait_time_total / self.jobs if self.jobs else 0.0,
+            "wait_time_max": self.wait_time_max
+        }
+
+
+class _NoSlot:
+    async def __aenter__(self):
+        return 0.0
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+NO_SLOT = _NoSlot()  # used when flows run without a scheduler
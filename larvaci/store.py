@@ -0,0 +1,175 @@
+import os
+import json
+import logging
+import sqlite3
+from collections import OrderedDict
+
+
+class PullRequestStore:
+    """ In-memory store of processed PR revisions keyed by (id, baseRefOid, headRefOid)
+
+    Keeps at most `capacity` records, the least recently saved ones are evicted first.
+    Subclasses persist every change as soon as it is made into `path`.
+    """
+    DEFAULT_FNAME = None  # nothing is persisted
+
+    def __init__(self, path=None, capacity=100):
+        self.path = path
+        self.capacity = capacity
+        self._records = OrderedDict()
+
+    @staticmethod
+    def key(pr):
+        return (pr["id"], pr["baseRefOid"], pr["headRefOid"])
+
+    def __len__(self):
+        return len(self._records)
+
+    def get(self, pr):
+        return self._records.get(self.key(pr))
+
+    def records(self):
+        return list(self._records.values())
+
+    def put(self, record):
+        evicted = self._put(record)
+        self._write(record, evicted)
+
+    def _put(self, record):
+        key = self.key(record)
+        self._records.pop(key, None)
+        self._records[key] = record
+
+        evicted = []
+        while len(self._records) > self.capacity:
+            evicted.append(self._records.popitem(last=False)[1])
+        return evicted
+
+    def _write(self, record, evicted):
+        pass
+
+    def close(self):
+        pass
+
+
+class JournalStore(PullRequestStore):
+    """ Append-only JSON lines journal, compacted once it has `compact_factor` times more lines than records """
+    DEFAULT_FNAME = "pull_requests.jsonl"
+
+    def __init__(self, path, capacity=100, compact_factor=4, fsync=False):
+        super().__init__(path, capacity=capacity)
+        self.compact_factor = compact_factor
+        self.fsync = fsync
+        self._lines = 0
+
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                for line in f:
+                    try:
+                        self._put(json.loads(line))
+                    except ValueError:
+                        logging.warning(f"Skip broken record in {self.path}: {line!r}")
+                    self._lines += 1
+        self._file = open(self.path, "a")
+
+    def _write(self, record, evicted):
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self._lines += 1
+
+        if self._lines > self.compact_factor * max(self.capacity, 1):
+            self.compact()
+
+    def compact(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            for record in self._records.values():
+                f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+        self._file.close()
+        os.replace(tmp_path, self.path)
+        self._file = open(self.path, "a")
+        self._lines = len(self._records)
+
+    def close(self):
+        self._file.close()
+
+
+class SqliteStore(PullRequestStore):
+    """ SQLite database in WAL mode, the whole table is cached in memory for lookups """
+    DEFAULT_FNAME = "pull_requests.sqlite"
+
+    def __init__(self, path, capacity=100):
+        super().__init__(path, capacity=capacity)
+        self._db = sqlite3.connect(self.path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS pull_requests (
+            id TEXT, base TEXT, head TEXT, seq INTEGER, record TEXT,
+            PRIMARY KEY (id, base, head)
+        )""")
+        self._db.commit()
+
+        self._seq = 0
+        for seq, record in self._db.execute("SELECT seq, record FROM pull_requests ORDER BY seq"):
+            self._seq = seq
+            for evicted in self._put(json.loads(record)):
+                self._db.execute("DELETE FROM pull_requests WHERE id=? AND base=? AND head=?", self.key(evicted))
+        self._db.commit()
+
+    def _write(self, record, evicted):
+        self._seq += 1
+        with self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO pull_requests VALUES (?, ?, ?, ?, ?)",
+                (*self.key(record), self._seq, json.dumps(record))
+            )
+            self._db.executemany(
+                "DELETE FROM pull_requests WHERE id=? AND base=? AND head=?",
+                [self.key(r) for r in evicted]
+            )
+
+    def close(self):
+        self._db.close()
+
+
+class ResultCache:
+    """ LRU cache of PR results keyed by merged tree hash, the JSON file is rewritten on every change """
+    DEFAULT_FNAME = "result_cache.json"
+
+    def __init__(self, path, capacity=1000):
+        self.path = path
+        self.capacity = capacity
+        self._entries = OrderedDict()
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r") as f:
+                    self._entries.update(json.load(f))
+            except ValueError:
+                logging.warning(f"Result cache {self.path} is broken, start from scratch")
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key, entry):
+        self._entries.pop(key, None)
+        self._entries[key] = entry
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+        self._save()
+
+    def _save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(list(self._entries.items()), f)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,197 @@
+import os
+import sys
+import json
+import time
+import signal
+import asyncio
+import logging
+import subprocess
+from .webhook import WebhookReceiver
+
+
+_HEALTH_FNAME = "supervisor.json"
+
+
+class FlowProcess:
+    """ Child process running one flow, restarted with exponential backoff when it crashes """
+
+    def __init__(self, name, flow_cls, args, env, stdio=None, min_backoff=1, max_backoff=300, stable_time=60):
+        """
+        `args` - command line of the child process
+        `stable_time` - a child running longer than this (seconds) resets the backoff
+        """
+        self.name = name
+        self.flow_cls = flow_cls
+        self.args = args
+        self.env = env
+        self.stdio = stdio
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.stable_time = stable_time
+
+        self.proc = None
+        self.state = "starting"
+        self.restarts = 0
+        self.started = None
+        self.last_returncode = None
+        self._failures = 0
+        self._stopping = asyncio.Event()
+
+    @property
+    def pid(self):
+        return self.proc.pid if self.proc is not None and self.proc.returncode is None else None
+
+    def health(self):
+        return {
+            "pid": self.pid,
+            "state": self.state,
+            "restarts": self.restarts,
+            "uptime": time.time() - self.started if self.pid is not None else None,
+            "last_returncode": self.last_returncode
+        }
+
+    def match_webhook(self, event, payload):
+        # a bare instance is enough for flows matching webhooks by their class attributes, others may need state
+        # of an initialized one, which lives in the child: an extra wakeup is cheaper than a missed one
+        try:
+            return self.flow_cls.match_webhook(self.flow_cls.__new__(self.flow_cls), event, payload)
+        except Exception as err:
+            logging.debug(f"Flow {self.name} can't match webhook '{event}' outside its process ({err!r}), wake it up")
+            return True
+
+    def wakeup(self):
+        self.send_signal(signal.SIGUSR1)
+
+    def send_signal(self, sig):
+        if self.pid is not None:
+            try:
+                self.proc.send_signal(sig)
+            except ProcessLookupError:
+                pass
+
+    async def run(self):
+        while not self._stopping.is_set():
+            self.proc = await asyncio.create_subprocess_exec(
+                *self.args,
+                env=self.env,
+                stdin=subprocess.DEVNULL,
+                stdout=self.stdio,
+                stderr=self.stdio,
+                start_new_session=True  # signals reach the child only via the supervisor
+            )
+            self.started = time.time()
+            self.state = "running"
+            logging.info(f"Flow {self.name} has been started in process PID={self.proc.pid}")
+
+            self.last_returncode = await self.proc.wait()
+            if self._stopping.is_set():
+                break
+
+            uptime = time.time() - self.started
+            self._failures = 0 if uptime > self.stable_time else self._failures + 1
+            delay = min(self.max_backoff, self.min_backoff * (2 ** self._failures))
+            self.state = "restarting"
+            self.restarts += 1
+            logging.error(f"Process of flow {self.name} has exited with code {self.last_returncode} "
+                          f"after {uptime:.1f} seconds, restart in {delay} seconds")
+            try:
+                await asyncio.wait_for(self._stopping.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+        self.state = "stopped"
+        logging.info(f"Process of flow {self.name} has been stopped")
+
+    async def stop(self, timeout=60):
+        self._stopping.set()
+        self.send_signal(signal.SIGTERM)
+        if self.proc is None:
+            return
+        try:
+            await asyncio.wait_for(self.proc.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"Process of flow {self.name} didn't stop in {timeout} seconds, kill it")
+            self.send_signal(signal.SIGKILL)
+
+
+async def supervise(flows, child_args, workdir_base, github_token, detached=False, webhook_port=None,
+                    webhook_host="0.0.0.0", webhook_secret=None, metrics_port=None, metrics_host="0.0.0.0",
+                    health_interval=10):
+    """ Run every flow from `flows` (name -> class) in its own process
+
+    `child_args` - command line starting the service, `--flow <name>` is appended for every child
+    `metrics_port` - the children serve metrics on consecutive ports starting from this one
+    """
+    logging.info("Start supervisor...")
+
+    env = dict(os.environ, GITHUB_ACCESS_TOKEN=github_token)
+    stdio = subprocess.DEVNULL if detached else None
+    children = []
+    for index, (name, flow_cls) in enumerate(flows.items()):
+        args = [*child_args, "--flow", name]
+        if metrics_port is not None:
+            args += ["--metrics-host", metrics_host, "--metrics-port", str(metrics_port + index)]
+            logging.info(f"Flow {name} serves metrics on {metrics_host}:{metrics_port + index}")
+        children.append(FlowProcess(name, flow_cls, args, env=env, stdio=stdio))
+    tasks = [asyncio.create_task(child.run()) for child in children]
+
+    stopping = asyncio.Event()
+
+    def stop():
+        logging.info("Stopping, terminate all flow processes...")
+        stopping.set()
+
+    eloop = asyncio.get_event_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        eloop.add_signal_handler(sig, stop)
+
+    webhooks = None
+    if webhook_port is not None:
+        webhooks = WebhookReceiver(children, secret=webhook_secret)
+        await webhooks.start(webhook_host, webhook_port)
+
+    health_path = os.path.join(workdir_base, _HEALTH_FNAME)
+    os.makedirs(workdir_base, exist_ok=True)
+    while not stopping.is_set():
+        health = {child.name: child.health() for child in children}
+        with open(health_path, "w") as f:
+            json.dump(health, f, indent=2)
+        logging.debug(f"Health of flows: {health}")
+        try:
+            await asyncio.wait_for(stopping.wait(), timeout=health_interval)
+        except asyncio.TimeoutError:
+            pass
+
+    if webhooks is not None:
+        await webhooks.stop()
+    await asyncio.gather(*(child.stop() for child in children))
+    await asyncio.gather(*tasks)
+
+    with open(health_path, "w") as f:
+        json.dump({child.name: child.health() for child in children}, f, indent=2)
+    logging.info("All flow processes have been stopped")
+
+
+def child_command(args, processes=1):
+    """ Command line re-running the current script with the same options, but without forking
+
+    `processes` - number of children sharing the CPU and memory budget, each gets an equal part of it
+    """
+    cmd = [sys.executable, sys.argv[0], "--work-dir", args.work_dir,
+           "--github-connections", str(args.github_connections)]
+    if args.github_url is not None:
+        cmd += ["--github-url", args.github_url]
+    if args.verbose:
+        cmd.append("--verbose")
+    if args.log_dir is not None:
+        cmd += ["--log-dir", args.log_dir]
+    if args.log_queue:
+        cmd.append("--log-queue")
+    if args.log_json:
+        cmd.append("--log-json")
+    if args.max_cpus is not None:
+        cmd += ["--max-cpus", str(max(1, args.max_cpus // processes))]
+    if args.max_memory is not None:
+        cmd += ["--max-memory", str(max(1, args.max_memory // processes))]
+    if processes > 1 and (args.max_cpus is not None or args.max_memory is not None):
+        logging.info(f"CPU and memory budget is divided between {processes} flow processes")
+    return cmd
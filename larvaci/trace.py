@@ -0,0 +1,122 @@
+""" Nested timed spans written as Chrome trace event JSON (chrome://tracing, Perfetto, speedscope)
+
+    trace = Trace()
+    with trace.activate():
+        with span("checkout", revision=oid):
+            ...
+    trace.write(os.path.join(rundir, "trace.json"))
+
+Spans go to the trace active in the current context (tasks inherit it), without an active trace `span()`
+returns a shared no-op object, so instrumented code costs a context variable lookup.
+"""
+import os
+import json
+import time
+import asyncio
+import contextlib
+import contextvars
+
+
+_current_trace = contextvars.ContextVar("larvaci_trace", default=None)
+
+
+class Trace:
+    def __init__(self, name=None):
+        self.name = name
+        self.events = []
+        self._t0 = time.perf_counter()
+        self._pid = os.getpid()
+        self._tids = {}
+
+    def _tid(self):
+        # every asyncio task is a "thread" of the trace, so spans of concurrent tasks don't mix up
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        tid = self._tids.get(task)
+        if tid is None:
+            tid = self._tids[task] = len(self._tids) + 1
+            get_name = getattr(task, "get_name", None)  # python 3.8+
+            self.events.append({
+                "ph": "M", "name": "thread_name", "pid": self._pid, "tid": tid,
+                "args": {"name": get_name() if get_name is not None else f"task {tid}"}
+            })
+        return tid
+
+    def add(self, name, cat, start, end, args):
+        self.events.append({
+            "ph": "X",
+            "name": name,
+            "cat": cat,
+            "ts": (start - self._t0) * 1e6,
+            "dur": (end - start) * 1e6,
+            "pid": self._pid,
+            "tid": self._tid(),
+            "args": args
+        })
+
+    @contextlib.contextmanager
+    def activate(self):
+        """ Make the trace current for the code (and tasks created) within the block """
+        token = _current_trace.set(self)
+        try:
+            yield self
+        finally:
+            _current_trace.reset(token)
+
+    def write(self, path):
+        trace = {"traceEvents": self.events, "displayTimeUnit": "ms", "otherData": {"name": self.name}}
+        with open(path, "w") as f:
+            json.dump(trace, f, default=str)
+
+
+class _Span:
+    __slots__ = ("trace", "name", "cat", "args", "start")
+
+    def __init__(self, trace, name, cat, args):
+        self.trace = trace
+        self.name = name
+        self.cat = cat
+        self.args = args
+        self.start = None
+
+    def set(self, **args):
+        """ Attach more arguments to the span, e.g. results """
+        self.args.update(args)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = time.perf_counter()
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        self.trace.add(self.name, self.cat, self.start, end, self.args)
+
+
+class _NoSpan:
+    def set(self, **args):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+def span(name, cat="larvaci", **args):
+    """ Context manager timing the block as a span of the current trace, no-op if there is no trace """
+    trace = _current_trace.get()
+    if trace is None:
+        return _NO_SPAN
+    return _Span(trace, name, cat, args)
+
+
+def current_trace():
+    return _current_trace.get()
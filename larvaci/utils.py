@@ -1,8 +1,22 @@
 from . import github as gh
 from .flow import FlowBase
+from .store import JournalStore, ResultCache
+from .log import current_pr
+from .rundirs import RunDirCollector, write_marker, trash
+from .metrics import Counter, Gauge
+from .trace import Trace, span
 import os
-import shutil
+import asyncio
 import time
+from datetime import datetime
+
+
+PR_QUEUE_DEPTH = Gauge("larvaci_pr_queue_depth", "PR revisions waiting to be processed", labels=("flow", ))
+PR_RESULTS = Counter("larvaci_prs_processed_total", "Processed PR revisions by result", labels=("flow", "result"))
+
+
+class RevisionSuperseded(Exception):
+    """ PR has got a new revision while the previous one was being processed """
 
 
 def are_equal_by_subset(d1, d2, keys):
@@ -19,9 +33,10 @@ def make_rundir(basedir, pr):
 
     rundir = os.path.join(basedir, f"runs/{date}_{base_ref}_{head_ref}")
     if os.path.exists(rundir):
-        shutil.rmtree(rundir)
+        trash(rundir)  # deleting a big tree would block the event loop, the collector does it
 
     os.makedirs(rundir)
+    write_marker(rundir, pr)
     return rundir
 
 
@@ -29,57 +44,457 @@ class PullRequestProcessorFlowBase(FlowBase):
     REPO_OWNER = None
     REPO_NAME = None
     MAX_ATTEMPTS = 3
+    MAX_PARALLEL = 1  # number of PRs processed at the same time
+    USE_WORKTREES = False  # run every PR in a fresh worktree of a shared bare mirror
+    POLL_CHANGES_ONLY = False  # skip the iteration if no PR has moved since the last poll
+    STORE_CLASS = JournalStore  # storage of processed PRs, see larvaci.store
+    STORE_CAPACITY = 100  # number of recent PR revisions to remember
+    JOB_CPUS = 1  # CPU slots of the shared scheduler taken by one PR run
+    JOB_MEMORY = 0  # memory (MiB) of the shared scheduler taken by one PR run
+    RESULT_CACHE_SIZE = 0  # results reused for revisions with the same merged tree, 0 disables the cache
+    RUNS_KEEP_PER_PR = None  # number of the most recent run dirs kept for every PR
+    RUNS_MAX_AGE = None  # run dirs older than this (seconds) are deleted
+    RUNS_MAX_SIZE = None  # total size (MiB) of run dirs, the oldest ones are deleted to fit in
+    RUNS_GC_INTERVAL = 600  # seconds between retention policy checks
+    CLONE_FILTER = None  # partial clone filter of checkouts and the mirror, e.g. "blob:none"
+    CLONE_DEPTH = None  # shallow clone depth of checkouts (not of the mirror)
+    SPARSE_PATHS = None  # directories to check out, None checks out everything
+    KEEP_PATHS = ()  # untracked paths `self.git.clean()` keeps between runs, e.g. ("build/", ".ccache/")
+    SUPERSEDE = False  # cancel runs of PR revisions which aren't the latest anymore and run the latest ones
+    SUPERSEDE_INTERVAL = 30  # seconds between checks of PRs being processed
 
     RES_SUCCESS = "success"
     RES_FAILURE = "failure"
     RES_CRASHED = "crashed"
+    RES_SUPERSEDED = "superseded"  # not counted as an attempt
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._ssh_url = None
+        self._snapshot = None
+        self._retry_pending = False
+        self._mirror_lock = asyncio.Lock()
+        self.dispatcher = None  # larvaci.dispatch.Coordinator, set by main_loop in coordinator mode
+        self.poller = None  # larvaci.poller.SharedPoller, set by main_loop if PRs of all flows are polled at once
+        self._bypass_poller = False  # woken up by something newer than the poller's snapshot (e.g. a webhook)
+
+        self.store = self.create_store()
+        for record in self.context.pop("__pull_requests", []):
+            self.store.put(record)  # migrate records kept in context.json by older versions
+        self.result_cache = self.create_result_cache() if self.RESULT_CACHE_SIZE > 0 else None
+        self.rundir_collector = RunDirCollector(
+            os.path.join(self.workdir, "runs"),
+            keep_per_pr=self.RUNS_KEEP_PER_PR,
+            max_age=self.RUNS_MAX_AGE,
+            max_size=self.RUNS_MAX_SIZE,
+            logger=self.logger
+        )
+        self._busy_rundirs = set()
+        self.git.keep_paths = self.KEEP_PATHS
+        self._queue_depth = PR_QUEUE_DEPTH.labels(self.name)
+        self._queue = None  # PRs of the running iteration waiting for local workers
+        self._running = {}  # PR id -> (PR, task of process_pull_request())
+        self._superseded = set()  # tasks cancelled because of a new revision
+        self._requeued = set()  # (id, headRefOid) of revisions queued instead of superseded ones
+        if self.SUPERSEDE:
+            # processes of a cancelled run must be stopped with all their children
+            self.command.new_session = True
+            self.git.cmd.new_session = True
+
+    def create_store(self):
+        fname = self.STORE_CLASS.DEFAULT_FNAME
+        path = os.path.join(self.workdir, fname) if fname is not None else None
+        return self.STORE_CLASS(path, capacity=self.STORE_CAPACITY)
+
+    def create_result_cache(self):
+        path = os.path.join(self.workdir, ResultCache.DEFAULT_FNAME)
+        return ResultCache(path, capacity=self.RESULT_CACHE_SIZE)
+
+    def shutdown(self):
+        super().shutdown()
+        self.store.close()
+
+    def background_tasks(self):
+        tasks = super().background_tasks() + [self.collect_rundirs()]
+        if self.SUPERSEDE:
+            tasks.append(self.watch_superseded())
+        return tasks
+
+    async def watch_superseded(self):
+        """ Cancel runs of PR revisions which have been updated or closed, queue the latest revisions instead """
+        while True:
+            await asyncio.sleep(self.SUPERSEDE_INTERVAL)
+            if not self._running:
+                continue
+            try:
+                latest = {pr["id"]: pr for pr in await self.open_pull_requests(light=True)}
+            except Exception:
+                self.logger.exception(f"Failed to check PRs being processed")
+                continue
+
+            for pr_id, (pr, task) in list(self._running.items()):
+                new = latest.get(pr_id)
+                if task in self._superseded or (new is not None and self.store.key(new) == self.store.key(pr)):
+                    continue
+                self.logger.info(f"PR {pr_id} has been updated or closed, cancel processing of its revision "
+                                 f"{pr['baseRefOid']}..{pr['headRefOid']}")
+                self._superseded.add(task)
+                task.cancel()
+                if new is not None and self._queue is not None:
+                    new_pr = dict(pr, baseRefOid=new["baseRefOid"], headRefOid=new["headRefOid"])
+                    ctx = self.get_pr_context(new_pr)
+                    if ctx is not None and ctx["result"] == self.RES_SUCCESS:
+                        continue
+                    self._requeued.add((pr_id, new_pr["headRefOid"]))
+                    self._queue.insert(0, (new_pr, ctx["attempt"] + 1 if ctx is not None else 1))
+                    self._queue_depth.set(len(self._queue))
+
+    async def _run_revision(self, repodir, pr, rundir):
+        """ Run process_pull_request() in its own task, so it can be cancelled once the revision is superseded """
+        if not self.SUPERSEDE:
+            return await self.process_pull_request(repodir=repodir, pr=pr, rundir=rundir)
+
+        task = asyncio.ensure_future(self.process_pull_request(repodir=repodir, pr=pr, rundir=rundir))
+        self._running[pr["id"]] = (pr, task)
+        try:
+            return await task
+        except asyncio.CancelledError:
+            if task not in self._superseded:
+                raise  # the flow is stopping
+            raise RevisionSuperseded()
+        finally:
+            self._superseded.discard(task)
+            if self._running.get(pr["id"], (None, None))[1] is task:
+                del self._running[pr["id"]]
+
+    async def collect_rundirs(self):
+        """ Enforce the run dirs retention policy every RUNS_GC_INTERVAL seconds, trashed dirs are always deleted """
+        while True:
+            try:
+                await self.rundir_collector.collect(busy=self._busy_rundirs)
+            except Exception:
+                self.logger.exception(f"Collection of run dirs has failed")
+            await asyncio.sleep(self.RUNS_GC_INTERVAL)
+
+    def match_webhook(self, event, payload):
+        if event not in ("push", "pull_request"):
+            return False
+        full_name = payload.get("repository", {}).get("full_name", "")
+        return full_name.lower() == f"{self.REPO_OWNER}/{self.REPO_NAME}".lower()
 
     async def process_pull_request(self, repodir, pr, rundir):
         raise NotImplementedError("process_pull_request() must be implemented in sublcasses")
 
     def save_processed_pull_request(self, pr, result, attempt):
-        pr_context = self.context.setdefault("__pull_requests", [])
-        pr_context.append({
+        PR_RESULTS.labels(self.name, result).inc()
+        if result == self.RES_SUPERSEDED:
+            attempt -= 1  # the revision isn't to blame, wherever it has been processed
+        self.store.put({
             "id": pr["id"],
             "baseRefOid": pr["baseRefOid"],
             "headRefOid": pr["headRefOid"],
             "result": result,
             "attempt": attempt
         })
-        del pr_context[:-100]  # remeber 100 recent PRs
     
     def was_pull_request_processed(self, pr):
-        for processed in self.context.get("__pull_requests", []):
-            if are_equal_by_subset(processed, pr, ("id", "baseRefOid", "headRefOid")):
-                return True
-        return False
+        return self.store.get(pr) is not None
     
     def get_pr_context(self, pr):
-        for ctx in self.context.get("__pull_requests", []):
-            if are_equal_by_subset(ctx, pr, ("id", "baseRefOid", "headRefOid")):
-                return ctx
-        return None
+        return self.store.get(pr)
 
-    async def run(self):
-        repodir = os.path.join(self.workdir, self.REPO_NAME)
+    def get_worker_repodir(self, worker):
+        # the first worker keeps the original location, so existing checkouts are reused
+        name = self.REPO_NAME if worker == 0 else f"{self.REPO_NAME}.{worker}"
+        return os.path.join(self.workdir, name)
 
-        response = await self.github.open_pull_requests(repo_owner=self.REPO_OWNER, repo_name=self.REPO_NAME)
+    async def get_ssh_url(self):
+        if self._ssh_url is None:
+            repository = await self.github.repository(repo_owner=self.REPO_OWNER, repo_name=self.REPO_NAME)
+            self._ssh_url = repository["sshUrl"]
+        return self._ssh_url
 
-        ssh_url = response["data"]["repository"]["sshUrl"]
+    async def prepare_repodir(self, repodir):
         if os.path.isdir(repodir):
             self.logger.debug(f"Check if {repodir} is valid repository...")
             retcode = await self.command.exec(["git", "remote", "-v"], cwd=repodir, noexcept=True)
             if retcode != 0:
                 self.logger.warning(f"{repodir} doesn't look like valid repository")
-                return  # TODO remove the dir
+                return False  # TODO remove the dir
 
         if not os.path.isdir(repodir):
             self.logger.info(f"Clone repository into {repodir} ...")
-            await self.git.clone(ssh_url, repodir)
+            await self.git.clone(
+                await self.get_ssh_url(), repodir,
+                filter=self.CLONE_FILTER,
+                depth=self.CLONE_DEPTH,
+                sparse=self.SPARSE_PATHS is not None
+            )
+            if self.SPARSE_PATHS is not None:
+                await self.git.sparse_checkout(repodir, self.SPARSE_PATHS)
             self.logger.info(f"Repository has been cloned into {repodir}")
+        return True
+
+    def get_mirror_dir(self):
+        return os.path.join(self.workdir, f"{self.REPO_NAME}.git")
+
+    async def fetch_pull_requests(self, repodir, prs, depth=None):
+        """ Fetch base and head commits of `prs` missing in `repodir` with one git invocation
+
+        Return False if the fetch has failed.
+        """
+        oids = [oid for pr in prs for oid in (pr["baseRefOid"], pr["headRefOid"])]
+        refspecs = [
+            f"+refs/pull/{pr['number']}/head:refs/remotes/origin/pull/{pr['number']}"
+            for pr in prs if pr.get("number") is not None
+        ]
+        refspecs += [
+            f"+refs/heads/{branch}:refs/remotes/origin/{branch}"
+            for branch in dict.fromkeys(pr["baseRefName"] for pr in prs if pr.get("baseRefName") is not None)
+        ]
+        try:
+            missing = await self.git.fetch_commits(repodir, oids, refspecs=refspecs, depth=depth)
+        except Exception:
+            self.logger.exception(f"Failed to fetch commits of {len(prs)} PRs into {repodir}")
+            return False
+        self.logger.debug(f"{len(missing)} of {len(set(oids))} commits were fetched into {repodir}")
+        return True
+
+    async def prepare_mirror(self, prs=None):
+        """ Clone or update the mirror, only commits of `prs` are fetched if they are given """
+        mirror_dir = self.get_mirror_dir()
+        if not os.path.isdir(mirror_dir):
+            self.logger.info(f"Mirror repository into {mirror_dir} ...")
+            await self.git.mirror(await self.get_ssh_url(), mirror_dir, filter=self.CLONE_FILTER)
+            self.logger.info(f"Repository has been mirrored into {mirror_dir}")
+        elif prs is None or not await self.fetch_pull_requests(mirror_dir, prs):
+            await self.git.fetch(mirror_dir)
+        await self.git.worktree_prune(mirror_dir)
+
+    async def _add_worktree(self, rundir, revision):
+        worktree_dir = os.path.abspath(os.path.join(rundir, self.REPO_NAME))  # git runs in the mirror
+        sparse = self.SPARSE_PATHS is not None
+        async with self._mirror_lock:
+            await self.git.worktree_add(self.get_mirror_dir(), worktree_dir, revision, checkout=not sparse)
+        if sparse:
+            await self.git.sparse_checkout(worktree_dir, self.SPARSE_PATHS)
+            await self.git.checkout(worktree_dir, revision)
+        return worktree_dir
 
-        prs = [edge["node"] for edge in response["data"]["repository"]["pullRequests"]["edges"]]
+    async def _remove_worktree(self, worktree_dir):
+        try:
+            async with self._mirror_lock:
+                await self.git.worktree_remove(self.get_mirror_dir(), worktree_dir)
+                await self.git.worktree_prune(self.get_mirror_dir())
+        except Exception:
+            self.logger.exception(f"Failed to remove worktree {worktree_dir}")
+
+    def result_cache_key(self, pr):
+        """ Extra part of the result cache key, override if results depend on more than sources (e.g. toolchain) """
+        return ""
+
+    async def get_result_cache_key(self, repodir, pr):
+        """ Hash of the tree the squash-merge of PR produces plus `result_cache_key()`, None if it's unknown """
+        repo_dir = self.get_mirror_dir() if self.USE_WORKTREES else repodir
+        try:
+            tree = await self.git.merge_tree(repo_dir, pr["baseRefOid"], pr["headRefOid"])
+        except Exception:
+            self.logger.exception(f"Failed to get merged tree of PR {pr['id']}")
+            return None
+        if tree is None:
+            self.logger.debug(f"Merged tree of PR {pr['id']} is unknown (conflict or missing commits)")
+            return None
+        return f"{tree}:{self.result_cache_key(pr)}"
+
+    async def reuse_result(self, pr, entry):
+        """ Mark PR with the result of another revision with the same merged tree """
+        await self.github.add_comment(
+            subject_id=pr["id"],
+            content=f"larvaci: {entry['result']} (reused result of {entry['headRefOid']} with the same merged tree)"
+        )
+
+    def job_priority(self, pr, attempt):
+        """ Scheduler priority of PR run, lower goes first: fresh revisions before retries, newest pushes first """
+        try:
+            updated = datetime.fromisoformat(pr["updatedAt"].replace("Z", "+00:00")).timestamp()
+        except (KeyError, AttributeError, ValueError):
+            updated = 0
+        return (attempt > 1, -updated)
+
+    async def process(self, repodir, pr, attempt):
+        """ Process one PR revision in `repodir` (None in worktree mode), return one of RES_* """
+        if not self.trace:
+            return await self._process_revision(repodir, pr, attempt)
+
+        # the iteration's trace gets one span, the run's own trace is written into its rundir
+        with span(f"PR {pr['id']}", cat="flow", attempt=attempt):
+            trace = Trace(name=f"{self.name} PR {pr['id']} ({pr['headRefOid']}), attempt {attempt}")
+            with trace.activate():
+                return await self._process_revision(repodir, pr, attempt, trace=trace)
+
+    async def _process_revision(self, repodir, pr, attempt, trace=None):
+        worktree_dir = None
+        rundir = None
+        cache_key = None
+        pr_token = current_pr.set(pr["id"])  # for JSON logs, the task's context is copied to subtasks
+        try:
+            if self.result_cache is not None and attempt == 1:  # retries run for real
+                with span("result cache lookup", cat="flow"):
+                    cache_key = await self.get_result_cache_key(repodir, pr)
+                entry = self.result_cache.get(cache_key) if cache_key is not None else None
+                if entry is not None and (entry["baseRefOid"], entry["headRefOid"]) == (pr["baseRefOid"], pr["headRefOid"]):
+                    entry = None  # its own result, the revision is being reprocessed
+                if entry is not None:
+                    self.logger.info(f"PR {pr} has the same merged tree as {entry['headRefOid']}, "
+                                     f"reuse its result={entry['result']}")
+                    await self.reuse_result(pr, entry)
+                    return entry["result"]
+
+            rundir = make_rundir(self.workdir, pr)
+            self._busy_rundirs.add(rundir)
+            if self.USE_WORKTREES:
+                repodir = worktree_dir = await self._add_worktree(rundir, pr["baseRefOid"])
+            slot = self.job_slot(
+                cpus=self.JOB_CPUS,
+                memory=self.JOB_MEMORY,
+                priority=self.job_priority(pr, attempt),
+                name=f"{self.name}/{pr['id']}"
+            )
+            with span("job", cat="flow") as job_span:
+                async with slot as waited:
+                    job_span.set(slot_wait=waited)
+                    self.logger.info(f"Start processing of PR {pr} (rundir={rundir})")
+                    with span("process_pull_request", cat="flow"):
+                        success = await self._run_revision(repodir, pr, rundir)
+            result = self.RES_SUCCESS if success else self.RES_FAILURE
+            self.logger.info(f"PR {pr} was processed, result={result}")
+            if self.result_cache is not None:
+                if cache_key is None:  # commits may have been fetched while processing
+                    cache_key = await self.get_result_cache_key(repodir, pr)
+                if cache_key is not None:
+                    self.result_cache.put(cache_key, {
+                        "result": result,
+                        "id": pr["id"],
+                        "baseRefOid": pr["baseRefOid"],
+                        "headRefOid": pr["headRefOid"]
+                    })
+            return result
+        except RevisionSuperseded:
+            self.logger.info(f"Processing of PR {pr} has been cancelled, the revision is superseded")
+            return self.RES_SUPERSEDED
+        except Exception:
+            self.logger.exception(f"Processing of PR failed with exception")
+            try:
+                await self.github.add_comment(subject_id=pr["id"], content=f"larvaci failed ({attempt} attempt), see logs")
+            except gh.GitHubError as err:
+                self.logger.error(f"Failed to report the crash to PR {pr['id']}: {err}")
+            return self.RES_CRASHED
+        finally:
+            if worktree_dir is not None:
+                await self._remove_worktree(worktree_dir)
+            self._busy_rundirs.discard(rundir)
+            current_pr.reset(pr_token)
+            if trace is not None and rundir is not None:
+                trace.write(os.path.join(rundir, "trace.json"))
+
+    async def _process(self, repodir, pr, attempt):
+        result = await self.process(repodir, pr, attempt)
+        self.save_processed_pull_request(pr, result, attempt)
+
+    async def _dispatch(self, pr, attempt):
+        try:
+            result = await self.dispatcher.submit(self.name, pr, attempt)
+        except Exception:
+            self.logger.exception(f"Dispatching of PR {pr} failed")
+            return
+        finally:
+            self._queue_depth.dec()
+        self.logger.info(f"PR {pr} was processed remotely, result={result}")
+        self.save_processed_pull_request(pr, result, attempt)
+
+    async def run_job(self, worker, pr, attempt):
+        """ Process a PR revision received from a coordinator, `worker` is the index of a local worker """
+        if self.USE_WORKTREES:
+            async with self._mirror_lock:  # other local workers may be preparing it right now
+                await self.prepare_mirror(prs=[pr])
+            repodir = None
+        else:
+            repodir = self.get_worker_repodir(worker)
+            if not await self.prepare_repodir(repodir):
+                raise RuntimeError(f"Could not prepare repository {repodir}")
+            await self.fetch_pull_requests(repodir, [pr], depth=self.CLONE_DEPTH)
+        return await self.process(repodir, pr, attempt)
+
+    async def _worker(self, worker, queue):
+        if self.USE_WORKTREES:
+            repodir = None  # every run gets its own worktree
+        else:
+            repodir = self.get_worker_repodir(worker)
+            try:
+                if not await self.prepare_repodir(repodir):
+                    return
+                # the worker may take any of queued PRs
+                await self.fetch_pull_requests(repodir, [pr for pr, _ in queue], depth=self.CLONE_DEPTH)
+            except Exception:
+                self.logger.exception(f"Failed to prepare {repodir}, other workers take the queued PRs")
+                return
+        while queue:
+            pr, attempt = queue.pop(0)
+            self._queue_depth.set(len(queue))
+            if (pr["id"], pr["headRefOid"]) in self._requeued:
+                self._requeued.discard((pr["id"], pr["headRefOid"]))
+                try:
+                    await self._prepare_revision(repodir, pr)
+                except Exception:
+                    self.logger.exception(f"Failed to fetch PR {pr}, it's left to the next iteration")
+                    continue
+            await self._process(repodir, pr, attempt)
+
+    async def _prepare_revision(self, repodir, pr):
+        """ Fetch commits of a revision queued after the iteration has started """
+        if self.USE_WORKTREES:
+            async with self._mirror_lock:
+                await self.prepare_mirror(prs=[pr])
+        else:
+            await self.fetch_pull_requests(repodir, [pr], depth=self.CLONE_DEPTH)
+
+    def wakeup(self, fresh=False):
+        """ `fresh` - the shared poller has a new snapshot, otherwise the next iteration queries GitHub itself """
+        if not fresh:
+            self._bypass_poller = True
+        super().wakeup()
+
+    async def open_pull_requests(self, light=False, bypass_poller=False):
+        """ Open PRs from the latest snapshot of the shared poller if there is one, from GitHub otherwise """
+        if self.poller is not None and not bypass_poller:
+            prs = self.poller.pull_requests(self.REPO_OWNER, self.REPO_NAME)
+            if prs is not None:
+                return prs
+        return [pr async for pr in self.github.open_pull_requests(
+            repo_owner=self.REPO_OWNER, repo_name=self.REPO_NAME, light=light)]
+
+    async def poll_changes(self, bypass_poller=False):
+        """ Return a snapshot of open PRs revisions or None if nothing has changed since the last run """
+        snapshot = {
+            pr["id"]: (pr["baseRefOid"], pr["headRefOid"])
+            for pr in await self.open_pull_requests(light=True, bypass_poller=bypass_poller)
+        }
+        if snapshot == self._snapshot and not self._retry_pending:
+            return None
+        return snapshot
+
+    async def run(self):
+        bypass_poller, self._bypass_poller = self._bypass_poller, False
+        if self.POLL_CHANGES_ONLY:
+            snapshot = await self.poll_changes(bypass_poller=bypass_poller)
+            if snapshot is None:
+                self.logger.debug(f"Open PRs haven't changed since the last poll")
+                return
+
+        prs = await self.open_pull_requests(bypass_poller=bypass_poller)
         self.logger.debug(f"There are {len(prs)} open PRs")
+
+        queue = []
         for pr in prs:
             ctx = self.get_pr_context(pr)
             if ctx is not None:
@@ -93,16 +508,37 @@ class PullRequestProcessorFlowBase(FlowBase):
             if attempt > self.MAX_ATTEMPTS:
                 self.logger.debug(f"PR {pr} has been tried to process {attempt} times")
                 continue
+            queue.append((pr, attempt))
+        jobs = list(queue)
+        self.active = bool(jobs)
+        self._queue_depth.set(len(queue))
 
+        if self.dispatcher is not None:
+            # a coordinator only polls, remote workers do the job
+            self.logger.debug(f"Dispatch {len(queue)} PRs to remote workers")
+            await asyncio.gather(*(self._dispatch(pr, attempt) for pr, attempt in queue))
+        else:
+            if self.USE_WORKTREES:
+                await self.prepare_mirror(prs=[pr for pr, _ in queue])
+
+            # each worker owns a separate checkout and takes PRs from the shared queue
+            workers = max(1, min(self.MAX_PARALLEL, len(queue)))
+            self.logger.debug(f"Process {len(queue)} PRs with {workers} workers")
+            self._queue = queue
+            tasks = [asyncio.ensure_future(self._worker(i, queue)) for i in range(workers)]
             try:
-                rundir = make_rundir(self.workdir, pr)
-                self.logger.info(f"Start processing of PR {pr} (rundir={rundir})")
-                success = await self.process_pull_request(repodir=repodir, pr=pr, rundir=rundir)
-                result = self.RES_SUCCESS if success else self.RES_FAILURE
-                self.logger.info(f"PR {pr} was processed, result={result}")
-                self.save_processed_pull_request(pr, result, attempt)
-                continue
-            except Exception:
-                self.logger.exception(f"Processing of PR failed with exception")
-                await self.github.add_comment(subject_id=pr["id"], content=f"larvaci failed ({attempt} attempt), see logs")
-                self.save_processed_pull_request(pr, self.RES_CRASHED, attempt)
+                await asyncio.gather(*tasks)
+            finally:
+                # no worker may outlive the iteration, the next one would process the same PRs in the same checkouts
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                self._queue = None
+                self._requeued.clear()
+
+        if self.POLL_CHANGES_ONLY:
+            self._snapshot = snapshot
+            self._retry_pending = any(
+                (self.get_pr_context(pr) or {}).get("result") != self.RES_SUCCESS and attempt < self.MAX_ATTEMPTS
+                for pr, attempt in jobs
+            )
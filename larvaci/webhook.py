@@ -0,0 +1,93 @@
+import hmac
+import json
+import hashlib
+import logging
+import aiohttp
+from aiohttp import web
+
+
+def _signature(secret, body):
+    return "sha256=" + hmac.new(secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+
+
+class WebhookReceiver:
+    """ HTTP endpoint for GitHub webhooks, wakes up flows matching received events """
+
+    def __init__(self, flows, secret=None, logger=None):
+        self.flows = flows
+        self.secret = secret
+        self.logger = logger or logging.getLogger()
+        self._runner = None
+
+    async def handle(self, request):
+        body = await request.read()
+        if self.secret is not None:
+            signature = request.headers.get("X-Hub-Signature-256", "")
+            if not hmac.compare_digest(signature, _signature(self.secret, body)):
+                self.logger.warning(f"Webhook from {request.remote} has invalid signature")
+                return web.Response(status=401, text="invalid signature")
+
+        event = request.headers.get("X-GitHub-Event")
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            return web.Response(status=400, text="invalid payload")
+
+        woken = []
+        for flow in self.flows:
+            try:
+                matched = flow.match_webhook(event, payload)
+            except Exception:
+                self.logger.exception(f"Flow {flow.name} has failed to match webhook '{event}'")
+                continue
+            if matched:
+                flow.wakeup()
+                woken.append(flow.name)
+
+        self.logger.info(f"Webhook '{event}' has woken up flows: {woken}")
+        return web.Response(text=json.dumps(woken))
+
+    async def start(self, host, port):
+        app = web.Application()
+        app.router.add_post("/", self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        self.logger.info(f"Listen to GitHub webhooks on {host}:{port}")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+async def send_webhook(url, event, payload, secret=None):
+    """ Local stand-in for GitHub: deliver webhook `event` with `payload` to `url` """
+    body = json.dumps(payload).encode("utf-8")
+    headers = {
+        "Content-Type": "application/json",
+        "X-GitHub-Event": event
+    }
+    if secret is not None:
+        headers["X-Hub-Signature-256"] = _signature(secret, body)
+
+    async with aiohttp.ClientSession() as session:
+        async with session.post(url, data=body, headers=headers) as response:
+            return response.status, await response.text()
+
+
+# -------------------------------------------------------------------------------------------------
+if __name__ == "__main__":
+    import argparse
+    import asyncio
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url",    help="Webhook receiver URL", default="http://127.0.0.1:8080/", type=str)
+    parser.add_argument("--event",  help="GitHub event name", default="push", type=str)
+    parser.add_argument("--repo",   help="Repository full name (owner/name)", required=True, type=str)
+    parser.add_argument("--secret", help="Webhook secret", default=None, type=str)
+
+    args = parser.parse_args()
+
+    payload = {"repository": {"full_name": args.repo}}
+    print(asyncio.run(send_webhook(args.url, args.event, payload, secret=args.secret)))